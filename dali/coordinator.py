@@ -0,0 +1,226 @@
+"""
+Polling of the gears on a DALI bus.
+
+One coordinator per bus queries the actual level of the gears and pushes the
+levels to the light and bus entities, so the bus state is derived from the
+same readings instead of querying every gear again.
+
+DALI carries only a few dozen forward frames per second, so polling is
+budgeted: the poller never sends more than poll_rate frames per second, and
+the commands to the lights and the queries of a bus scan are counted against
+that budget. Each gear is
+polled at its own interval, which drops to MIN_POLL_INTERVAL when the gear
+was commanded or changed, to follow its fade, and doubles up to
+MAX_POLL_INTERVAL every time it is found unchanged. When more gears are due
+than the budget allows, the most overdue goes first.
+
+Commands preempt polling: while a command waits for the bus, no poll
+starts, so a command waits at most for the one query already on the wire.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+_LOGGER = logging.getLogger(__name__)
+
+POLL_RATE = 10  # frames per second
+MIN_POLL_INTERVAL = 1  # seconds
+MAX_POLL_INTERVAL = 60  # seconds
+
+
+class DALICoordinator(object):
+    """Levels of the gears on a DALI bus, by short address."""
+
+    def __init__(self, driver, driver_lock, controller_name,
+                 poll_rate=POLL_RATE):
+        """Initialize a coordinator without gears.
+
+        Args:
+            poll_rate (float): frames per second available to polling and
+                commands
+        """
+        self.driver = driver
+        self.driver_lock = driver_lock
+        self.controller_name = controller_name
+        self.poll_rate = poll_rate
+        self.lamps = []
+        self.levels = {}
+        self._listeners = []
+        self._condition = threading.Condition()
+        self._interval = {}
+        self._due = {}
+        self._next_frame = 0
+        self._commands = 0
+        self._stopped = False
+
+    def set_lamps(self, lamps):
+        """Change the gears polled, forgetting the levels of removed ones.
+
+        New gears are due right away.
+        """
+        with self._condition:
+            self.lamps = list(lamps)
+            addresses = set(lamp.address for lamp in self.lamps)
+            for address in set(self.levels) - addresses:
+                del self.levels[address]
+            for address in set(self._due) - addresses:
+                del self._due[address]
+                del self._interval[address]
+            for address in addresses - set(self._due):
+                self._due[address] = 0
+                self._interval[address] = MIN_POLL_INTERVAL
+            self._condition.notify_all()
+
+    def add_listener(self, listener):
+        """Call listener(addresses) when the level of addresses changed.
+
+        Returns:
+            callable that removes the listener
+        """
+        self._listeners.append(listener)
+
+        def remove_listener():
+            """Remove the listener."""
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+        return remove_listener
+
+    @contextmanager
+    def command(self):
+        """Hold the bus for a command, ahead of any poll waiting for it."""
+        with self._condition:
+            self._commands += 1
+        try:
+            with self.driver_lock:
+                yield
+        finally:
+            with self._condition:
+                self._commands -= 1
+                self._spend_frame(time.monotonic())
+                self._condition.notify_all()
+
+    @contextmanager
+    def frame(self):
+        """Hold the bus for a query outside polling, e.g. to scan the bus.
+
+        Waits for a frame of the budget, behind any command waiting for the
+        bus, like a poll.
+        """
+        with self._condition:
+            while not self._stopped:
+                now = time.monotonic()
+                if not self._commands and self._next_frame <= now:
+                    break
+                self._condition.wait(
+                    None if self._commands else self._next_frame - now)
+            self._spend_frame(time.monotonic())
+        with self.driver_lock:
+            yield
+
+    def set_levels(self, addresses, level):
+        """Record the level just commanded to addresses.
+
+        The gears are polled again soon, to follow their fade.
+        """
+        changed = set()
+        with self._condition:
+            now = time.monotonic()
+            for address in addresses:
+                if address not in self._due:
+                    continue
+                self._touch(address, now)
+                if self.levels.get(address, -1) != level:
+                    self.levels[address] = level
+                    changed.add(address)
+            self._condition.notify_all()
+        self._notify(changed)
+
+    def stop(self, event=None):
+        """Stop the poller."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def run(self):
+        """Poll the gears as they fall due, until stopped."""
+        while True:
+            lamp = self._wait_next()
+            if lamp is None:
+                return
+            level = self._query(lamp)
+            self._record(lamp.address, level)
+
+    def _touch(self, address, now):
+        """Poll address at the shortest interval, from now on."""
+        self._interval[address] = MIN_POLL_INTERVAL
+        self._due[address] = min(self._due[address], now + MIN_POLL_INTERVAL)
+
+    def _spend_frame(self, now):
+        """Count a frame against the budget."""
+        self._next_frame = max(self._next_frame, now) + 1 / self.poll_rate
+
+    def _wait_next(self):
+        """Wait for the next gear to poll, and reserve its frame.
+
+        Returns:
+            Short address of the gear, or None once stopped
+        """
+        with self._condition:
+            while not self._stopped:
+                now = time.monotonic()
+                timeout = None
+                if not self._commands and self.lamps:
+                    lamp = min(self.lamps,
+                               key=lambda lamp: self._due[lamp.address])
+                    start = max(self._due[lamp.address], self._next_frame)
+                    if start <= now:
+                        self._spend_frame(now)
+                        return lamp
+                    timeout = start - now
+                self._condition.wait(timeout)
+        return None
+
+    def _query(self, lamp):
+        """Return the actual level of lamp, False if it can't be known."""
+        from dali.gear.general import QueryActualLevel
+        from dali.command import ResponseError, MissingResponse
+        import usb
+
+        try:
+            with self.driver_lock:
+                r = self.driver.send(QueryActualLevel(lamp))
+            _LOGGER.debug("DALI update: lamp {} brightness is {}".format(lamp.address, r))
+            return r.value if r and isinstance(r.value, int) else None
+        except usb.core.USBError as e:
+            _LOGGER.error("Can't update {}: {}".format(self.controller_name, e))
+        except ResponseError as e:
+            _LOGGER.error("ResponseError QueryActualLevel of lamp {}: {}".format(lamp.address, e))
+        except MissingResponse:
+            return None
+        return False
+
+    def _record(self, address, level):
+        """Store a polled level and schedule the next poll of address."""
+        changed = set()
+        with self._condition:
+            if address not in self._due:
+                return
+            now = time.monotonic()
+            if level is not False and self.levels.get(address, -1) != level:
+                self.levels[address] = level
+                changed.add(address)
+                self._interval[address] = MIN_POLL_INTERVAL
+            else:
+                self._interval[address] = min(2 * self._interval[address],
+                                              MAX_POLL_INTERVAL)
+            self._due[address] = now + self._interval[address]
+        self._notify(changed)
+
+    def _notify(self, changed):
+        """Call the listeners if any level changed."""
+        if not changed:
+            return
+        for listener in list(self._listeners):
+            listener(changed)
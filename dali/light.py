@@ -3,12 +3,21 @@ Support for DALI lights.
 
 """
 import logging
+import threading
+from datetime import timedelta
 import voluptuous as vol
-from homeassistant.const import (CONF_NAME, CONF_ID, CONF_DEVICES)
+from homeassistant.const import (
+    CONF_NAME, CONF_ID, CONF_DEVICES, EVENT_HOMEASSISTANT_STOP)
 from homeassistant.components.light import (
     ATTR_BRIGHTNESS, SUPPORT_BRIGHTNESS, LightEntity, PLATFORM_SCHEMA)
+from homeassistant.helpers.event import track_time_interval
 import homeassistant.helpers.config_validation as cv
 
+from .coordinator import DALICoordinator, POLL_RATE
+from .topology import (
+    TopologyCache, TOPOLOGY_FILE, ATTR_DEVICE_TYPE, ATTR_MIN_LEVEL,
+    ATTR_MAX_LEVEL)
+
 REQUIREMENTS = ['python-dali']
 
 #logging.basicConfig(level=logging.DEBUG)
@@ -20,9 +29,12 @@ SUPPORT_DALI = SUPPORT_BRIGHTNESS
 CONF_MAX_GEARS = "max_gears"
 CONF_DRIVERS = "drivers"
 CONF_MAX_BUSES = "max_buses"
+CONF_RESCAN_INTERVAL = "rescan_interval"
+CONF_POLL_RATE = "poll_rate"
 
 MAX_RANGE = 64
 MAX_BUSES = 4
+RESCAN_INTERVAL = timedelta(hours=12)
 
 DRIVER_SCHEMA = vol.Schema({
     vol.Required(CONF_NAME): cv.string,
@@ -31,81 +43,220 @@ DRIVER_SCHEMA = vol.Schema({
 
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Optional(CONF_MAX_BUSES, default=MAX_BUSES): cv.positive_int,
+    vol.Optional(CONF_RESCAN_INTERVAL, default=RESCAN_INTERVAL): cv.time_period,
+    vol.Optional(CONF_POLL_RATE, default=POLL_RATE): cv.positive_int,
     vol.Required(CONF_DRIVERS, default=[]): vol.All(cv.ensure_list, [DRIVER_SCHEMA]),
 })
 
 def setup_platform(hass, config, add_devices, discovery_info=None):
-    """Set up the DALI Light platform."""
-
-    from dali.address import Short
-    from dali.command import YesNoResponse, Response
-    import dali.gear.general as gear
+    """Set up the DALI Light platform.
+
+    Entities of the buses found in the topology cache are created right
+    away. Every driver is then scanned in its own thread, which adds or
+    retires entities when its bus changed, so neither startup nor the other
+    buses wait on it. The same thread then polls the levels of the bus
+    through its coordinator.
+    """
     from dali.driver.hasseb import SyncHassebDALIUSBDriverFactory
-    from dali.driver.hasseb import SyncHassebDALIUSBDriver 
-    import threading
 
     dali_drivers = SyncHassebDALIUSBDriverFactory() 
+    cache = TopologyCache(hass.config.path(TOPOLOGY_FILE))
 
     for idx, dali_driver in enumerate(dali_drivers):
         _LOGGER.debug("Found DALI driver")
-        lock = threading.RLock()
+        if idx >= len(config[CONF_DRIVERS]):
+            _LOGGER.error("No configuration for DALI driver {}".format(idx))
+            break
 
         driver_config = config[CONF_DRIVERS][idx]
+        topology = DALITopology(add_devices, cache, dali_driver,
+                                threading.RLock(), driver_config[CONF_NAME],
+                                driver_config[CONF_MAX_GEARS],
+                                config[CONF_MAX_BUSES], idx,
+                                config[CONF_POLL_RATE])
+        topology.load()
+
+        threading.Thread(target=topology.start, name="dali_{}".format(idx),
+                         daemon=True).start()
+        track_time_interval(hass, topology.rescan,
+                            config[CONF_RESCAN_INTERVAL])
+        hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP,
+                             topology.coordinator.stop)
+
+class DALITopology(object):
+    """Entities of the gears on a DALI bus, kept in sync with the bus."""
+
+    def __init__(self, add_devices, cache, driver, driver_lock,
+                 controller_name, max_gears, max_buses, bus_index,
+                 poll_rate=POLL_RATE):
+        """Initialize an empty topology."""
+        self.add_devices = add_devices
+        self.cache = cache
+        self.driver = driver
+        self.driver_lock = driver_lock
+        self.controller_name = controller_name
+        self.max_gears = max_gears
+        self.max_buses = max_buses
+        self.bus_index = bus_index
+        self.gears = None
+        self.lights = {}
+        self.bus = None
+        self.coordinator = DALICoordinator(driver, driver_lock,
+                                           controller_name, poll_rate)
+        self.rescan_lock = threading.Lock()
+
+    def load(self):
+        """Create the entities of the cached gears."""
+        gears = self.cache.get(self.bus_index, self.controller_name)
+        if gears is not None:
+            _LOGGER.debug("{} cached lamps on {}".format(len(gears), self.controller_name))
+            self.apply(gears)
+
+    def start(self):
+        """Scan the bus, then poll the levels of its gears until stopped."""
+        self.rescan()
+        self.coordinator.run()
+
+    def rescan(self, now=None):
+        """Scan the bus, and update the entities and the cache."""
+        if not self.rescan_lock.acquire(blocking=False):
+            return
+        try:
+            lamps = discover_gears(self.coordinator, self.max_gears)
+            if lamps is None:
+                return
+            _LOGGER.debug("Found {} lamps on {}".format(len(lamps), self.controller_name))
+
+            gears = {}
+            for lamp in lamps:
+                if self.gears is not None and lamp.address in self.gears:
+                    gears[lamp.address] = self.gears[lamp.address]
+                else:
+                    gears[lamp.address] = query_gear_info(
+                        self.coordinator, lamp)
+            if gears != self.gears:
+                self.apply(gears)
+                self.cache.set(self.bus_index, self.controller_name, gears)
+        finally:
+            self.rescan_lock.release()
+
+    def apply(self, gears):
+        """Add the entities of new gears and retire the missing ones."""
+        from dali.address import Short
+
+        for address in set(self.lights) - set(gears):
+            _LOGGER.info("Lamp {} left {}".format(address, self.controller_name))
+            light = self.lights.pop(address)
+            if light.hass is not None:
+                light.hass.add_job(light.async_remove)
+
+        new_lights = []
+        for address in sorted(set(gears) - set(self.lights)):
+            light = self.lights[address] = DALILight(
+                self.coordinator, self.controller_name, Short(address),
+                self.bus_index, gears[address])
+            new_lights.append(light)
+
+        lamps = [Short(address) for address in sorted(gears)]
+        self.coordinator.set_lamps(lamps)
+        if new_lights:
+            self.add_devices(new_lights)
+
+        if self.bus is None:
+            self.bus = DALIBus(self.coordinator, self.controller_name, lamps,
+                               self.max_buses, self.bus_index)
+            self.add_devices([self.bus])
+        else:
+            self.bus.set_lamps(lamps)
+        self.gears = gears
+
+def discover_gears(coordinator, max_gears):
+    """Return the short addresses of the gears on the bus of coordinator.
+
+    A broadcast QueryControlGearPresent first checks for any gear at all, so
+    an empty bus costs a single query instead of max_gears. Every query takes
+    a frame of the poll budget, and the bus is only held for each query, so
+    the entities keep using the bus meanwhile.
+
+    Returns None if the driver failed.
+    """
+    from dali.address import Broadcast, Short
+    from dali.command import YesNoResponse
+    import dali.gear.general as gear
 
-        lamps = []
-        for lamp in range(0, driver_config[CONF_MAX_GEARS]):
-            try: # @TODO initialize new gears
-                _LOGGER.debug("Searching for Gear on address <{}>".format(lamp))
+    dali_driver = coordinator.driver
+    lamps = []
+    try:
+        with coordinator.frame():
+            r = dali_driver.send(gear.QueryControlGearPresent(Broadcast()))
+        if not (isinstance(r, YesNoResponse) and r.value):
+            _LOGGER.debug("No gear on the bus")
+            return lamps
+
+        for lamp in range(0, max_gears):
+            # @TODO initialize new gears
+            _LOGGER.debug("Searching for Gear on address <{}>".format(lamp))
+            with coordinator.frame():
                 r = dali_driver.send(gear.QueryControlGearPresent(Short(lamp)))
 
-                if isinstance(r, YesNoResponse) and r.value:
-                    _LOGGER.debug("Found lamp!")
-                    lamps.append(Short(lamp))
+            if isinstance(r, YesNoResponse) and r.value:
+                _LOGGER.debug("Found lamp!")
+                lamps.append(Short(lamp))
 
-            except Exception as e:
-                # This will often mean that the driver wasn't found
-                _LOGGER.error("Error while QueryControlGearPresent: {}".format(e))
-                _LOGGER.error("Hasseb DALI master not found")
-                break
+    except Exception as e:
+        # This will often mean that the driver wasn't found
+        _LOGGER.error("Error while QueryControlGearPresent: {}".format(e))
+        _LOGGER.error("Hasseb DALI master not found")
+        return None
+
+    return lamps
+
+def query_gear_info(coordinator, lamp):
+    """Return the static data of the gear at short address lamp.
 
-        add_devices([DALILight(dali_driver, lock, driver_config[CONF_NAME], l, idx) for l in lamps])
-        add_devices([DALIBus(dali_driver, lock, driver_config[CONF_NAME], lamps, config[CONF_MAX_BUSES], idx)])
+    Data the gear doesn't answer is None. Every query takes a frame of the
+    poll budget.
+    """
+    from dali.command import ResponseError, MissingResponse
+    import dali.gear.general as gear
+
+    info = {}
+    for attr, query in ((ATTR_DEVICE_TYPE, gear.QueryDeviceType),
+                        (ATTR_MIN_LEVEL, gear.QueryMinLevel),
+                        (ATTR_MAX_LEVEL, gear.QueryMaxLevel)):
+        try:
+            with coordinator.frame():
+                r = coordinator.driver.send(query(lamp))
+            info[attr] = r.value if isinstance(r.value, int) else None
+        except (ResponseError, MissingResponse) as e:
+            _LOGGER.debug("{} of lamp {}: {}".format(attr, lamp.address, e))
+            info[attr] = None
+    return info
 
 class DALILight(LightEntity):
     """Representation of an DALI light."""
 
-    def __init__(self, driver, driver_lock, controller_name, ballast, bus_index):
-        from dali.gear.general import QueryActualLevel
-        from dali.command import ResponseError, MissingResponse
+    def __init__(self, coordinator, controller_name, ballast, bus_index, gear_info=None):
+        """Initialize a DALI light.
 
-        """Initialize a DALI light."""
+        The state is pushed by the coordinator of the bus, gear_info is the
+        static data of the gear from the topology cache.
+        """
         self._brightness = 0
         self._state = False
         self._name = "{}_{}".format(controller_name, ballast.address)
         self.attributes = {"short_address": ballast.address}
-        
-        self.driver = driver
-        self.driver_lock = driver_lock
+        if gear_info:
+            self.attributes.update(gear_info)
+
+        self.coordinator = coordinator
+        self.driver = coordinator.driver
         self.addr = ballast
+        self._remove_listener = None
 
         # A range of MAX_RANGE unique lamp IDs is allocated for each bus
         self._unique_id = (MAX_RANGE * bus_index) + self.addr.address
 
-        try:
-            with self.driver_lock:
-                cmd = QueryActualLevel(self.addr)
-                r = self.driver.send(cmd)
-                if r.value != None and r.value < 255:
-                    self._brightness = r.value
-                    if r.value > 0:
-                        r.state = True
-
-        except ResponseError as e:
-            _LOGGER.error("Response error on __init__")
-        except MissingResponse as e:
-            self._brightness = None
-            self._state = None
-
     @property
     def name(self):
         """Return the display name of this light."""
@@ -141,71 +292,71 @@ class DALILight(LightEntity):
     def turn_on(self, **kwargs):
         """Instruct the light to turn on."""
         from dali.gear.general import DAPC
- 
-        with self.driver_lock:
+        import usb
+
+        level = kwargs.get(ATTR_BRIGHTNESS, 254)
+        if level == 255:
+            level = 254
+        with self.coordinator.command():
             try:
-                self._brightness = kwargs.get(ATTR_BRIGHTNESS, 254)
-                _LOGGER.debug("turn on {}".format(self._brightness))
-                cmd = DAPC(self.addr, 254 if self._brightness==255 else self._brightness)
-                r = self.driver.send(cmd)
-                if self._brightness > 0:
-                    self._state = True
+                _LOGGER.debug("turn on {}".format(level))
+                r = self.driver.send(DAPC(self.addr, level))
             except usb.core.USBError as e:
                 _LOGGER.error("Can't turn_on {}: {}".format(self._name, e))
-        self.schedule_update_ha_state()
+                return
+        self.coordinator.set_levels([self.addr.address], level)
 
     def turn_off(self, **kwargs):
         """Instruct the light to turn off."""
-        from dali.gear.general import Off 
+        from dali.gear.general import Off
+        import usb
 
-        with self.driver_lock:
+        with self.coordinator.command():
             try:
-                cmd = Off(self.addr)
-                r = self.driver.send(cmd)
-                self._state = False 
+                r = self.driver.send(Off(self.addr))
             except usb.core.USBError as e:
-                _LOGGER.error("Can't turn_on {}: {}".format(self._name, e))
-        self.schedule_update_ha_state()
+                _LOGGER.error("Can't turn_off {}: {}".format(self._name, e))
+                return
+        self.coordinator.set_levels([self.addr.address], 0)
 
     @property
     def should_poll(self):
-        """Polling is now needed so that DALI bus and DALI light states will sync"""
-        return True
-
-    def update(self):
-        """Fetch update state."""
-        from dali.gear.general import QueryActualLevel
-        from dali.command import ResponseError, MissingResponse
-        import usb
-
-        with self.driver_lock:
-            try:
-                r = self.driver.send(QueryActualLevel(self.addr))
-                _LOGGER.debug("DALI Light update: new brightness is {}".format(r))
-                if r:
-                    self._brightness = r.value
-                    if 0 < int(self._brightness) < 255:
-                        self._state = True
-                    else:
-                        self._state = False
-                else:
-                    _LOGGER.error("return value = {}", r)
-            except usb.core.USBError as e:
-                _LOGGER.error("Can't update {}: {}".format(self._name, e))
-            except ResponseError as e:
-                _LOGGER.error("ResponseError QueryActualLevel")
-            except MissingResponse as e:
-                self._brightness = None
+        """The coordinator of the bus pushes the state."""
+        return False
+
+    async def async_added_to_hass(self):
+        """Listen to the levels polled by the coordinator."""
+        self._remove_listener = self.coordinator.add_listener(self._levels_changed)
+        self._update_from_level()
+
+    async def async_will_remove_from_hass(self):
+        """Stop listening to the coordinator."""
+        if self._remove_listener is not None:
+            self._remove_listener()
+            self._remove_listener = None
+
+    def _levels_changed(self, addresses):
+        """Update the state if the level of this light changed."""
+        if self.addr.address in addresses:
+            self._update_from_level()
+            self.schedule_update_ha_state()
+
+    def _update_from_level(self):
+        """Set the state from the level cached by the coordinator."""
+        if self.addr.address not in self.coordinator.levels:
+            return
+        level = self.coordinator.levels[self.addr.address]
+        _LOGGER.debug("DALI Light update: new brightness is {}".format(level))
+        self._brightness = level
+        self._state = level is not None and 0 < level < 255
 
 class DALIBus(LightEntity):
     """Representation of a DALI bus."""
 
-    def __init__(self, driver, driver_lock, controller_name, ballasts, max_buses, bus_index):
-        from dali.gear.general import QueryActualLevel
-        from dali.command import ResponseError, MissingResponse
+    def __init__(self, coordinator, controller_name, ballasts, max_buses, bus_index):
         from dali.address import Broadcast
 
-        """Initialize a DALI bus."""
+        """Initialize a DALI bus, its state is pushed by the coordinator."""
         self._brightness = 0
         self._state = False
         self._name = "{} bus".format(controller_name)
@@ -213,67 +364,52 @@ class DALIBus(LightEntity):
         self.lamp_addresses = ballasts
         self.attributes = {"short_addresses": [ballast.address for ballast in ballasts] }
 
-        self.driver = driver
-        self.driver_lock = driver_lock
+        self.coordinator = coordinator
+        self.driver = coordinator.driver
         self.addr = Broadcast()
+        self._remove_listener = None
 
         # Unique IDs for DALI buses are allocated after the last lamp ID range
         self._unique_id = max_buses * MAX_RANGE + bus_index
 
-        self.calculate_bus_state()
+    def set_lamps(self, ballasts):
+        """Change the lamps of the bus after a rescan."""
+        self.lamp_addresses = ballasts
+        self.attributes = {"short_addresses": [ballast.address for ballast in ballasts] }
+        if self.hass is not None:
+            self.calculate_bus_state()
+            self.schedule_update_ha_state()
 
     def calculate_bus_state(self):
-        from dali.gear.general import QueryActualLevel
-        from dali.command import ResponseError, MissingResponse
-        import usb
-
         """The state of a DALI bus will be the same state as the lights hanging 
         from it if all of them are consistent. If they are not, the state of the 
-        bus will be off. """
+        bus will be off. The levels are the ones cached by the coordinator."""
+        levels = self.coordinator.levels
+        last_brightness = None
 
-        try:
-            with self.driver_lock:
+        for lamp_address in self.lamp_addresses:
+            level = levels.get(lamp_address.address)
+
+            # Check if brightness is a valid value
+            # If so, and if it's either the first light or if it has the same value as the lights
+            # checked before, save value and keep checking
+            if level != None and level < 255 and (last_brightness == None or last_brightness == level):
+                last_brightness = level
+
+            else: # if not, bus status is not consistent; stop checking
+                _LOGGER.debug("Lamp {} returned invalid or different value; bus status is not consistent".format(lamp_address.address))
                 last_brightness = None
+                break
 
-                for lamp_address in self.lamp_addresses:
-                    # Query brightness
-                    result = self.driver.send(QueryActualLevel(lamp_address))
-                    _LOGGER.debug("DALI Bus update: lamp {} brightness is {}".format(lamp_address.address, result.value))
-
-                    # Check if brightness is a valid value
-                    # If so, and if it's either the first light or if it has the same value as the lights
-                    # checked before, save value and keep checking
-                    if result.value != None and int(result.value) < 255 and (last_brightness == None or last_brightness == int(result.value)):
-                        last_brightness = int(result.value)
-
-                    else: # if not, bus status is not consistent; stop checking
-                        _LOGGER.debug("Lamp {} returned invalid or different value; bus status is not consistent")
-                        last_brightness = None 
-                        break
-
-            _LOGGER.debug("DALI Bus update: new brightness is {}".format(last_brightness))
-
-            self._brightness = last_brightness
-            if self._brightness == None:
-                self._state = None
-            elif self._brightness > 0:
-                self._state = True
-            else:
-                self._state = False
-
-        # @XXX should unify these if I can't different causes / behavior
-        except usb.core.USBError as e:
-            _LOGGER.error("USB Error {}: {}".format(self._name, e))
-            self._brightness = None
-            self._state = None
-        except ResponseError as e:
-            _LOGGER.error("Response Error in QueryActualLevel: {}: {}".format(self._name, e))
-            self._brightness = None
-            self._state = None
-        except MissingResponse as e:
-            _LOGGER.error("Missing response: {}: {}".format(self._name, e))
-            self._brightness = None
+        _LOGGER.debug("DALI Bus update: new brightness is {}".format(last_brightness))
+
+        self._brightness = last_brightness
+        if self._brightness == None:
             self._state = None
+        elif self._brightness > 0:
+            self._state = True
+        else:
+            self._state = False
 
     @property
     def name(self):
@@ -311,37 +447,50 @@ class DALIBus(LightEntity):
     def turn_on(self, **kwargs):
         """Instruct the light to turn on."""
         from dali.gear.general import DAPC
- 
-        with self.driver_lock:
+        import usb
+
+        level = kwargs.get(ATTR_BRIGHTNESS, 254)
+        if level == 255:
+            level = 254
+        with self.coordinator.command():
             try:
-                self._brightness = kwargs.get(ATTR_BRIGHTNESS, 254)
-                _LOGGER.debug("turn on {}".format(self._brightness))
-                cmd = DAPC(self.addr, 254 if self._brightness==255 else self._brightness)
-                r = self.driver.send(cmd)
-                if self._brightness > 0:
-                    self._state = True
+                _LOGGER.debug("turn on {}".format(level))
+                r = self.driver.send(DAPC(self.addr, level))
             except usb.core.USBError as e:
                 _LOGGER.error("Can't turn_on {}: {}".format(self._name, e))
-        self.schedule_update_ha_state()
+                return
+        self.coordinator.set_levels([lamp.address for lamp in self.lamp_addresses], level)
 
     def turn_off(self, **kwargs):
         """Instruct the light to turn off."""
-        from dali.gear.general import Off 
+        from dali.gear.general import Off
+        import usb
 
-        with self.driver_lock:
+        with self.coordinator.command():
             try:
-                cmd = Off(self.addr)
-                r = self.driver.send(cmd)
-                self._state = False 
+                r = self.driver.send(Off(self.addr))
             except usb.core.USBError as e:
-                _LOGGER.error("Can't turn_on {}: {}".format(self._name, e))
-        self.schedule_update_ha_state()
+                _LOGGER.error("Can't turn_off {}: {}".format(self._name, e))
+                return
+        self.coordinator.set_levels([lamp.address for lamp in self.lamp_addresses], 0)
 
     @property
     def should_poll(self):
-        """Polling is now needed so that DALI bus and DALI light states will sync"""
-        return True
+        """The coordinator of the bus pushes the state."""
+        return False
 
-    def update(self):
-        """Fetch update state."""
+    async def async_added_to_hass(self):
+        """Listen to the levels polled by the coordinator."""
+        self._remove_listener = self.coordinator.add_listener(self._levels_changed)
         self.calculate_bus_state()
+
+    async def async_will_remove_from_hass(self):
+        """Stop listening to the coordinator."""
+        if self._remove_listener is not None:
+            self._remove_listener()
+            self._remove_listener = None
+
+    def _levels_changed(self, addresses):
+        """Derive the bus state again from the cached levels."""
+        self.calculate_bus_state()
+        self.schedule_update_ha_state()
@@ -0,0 +1,60 @@
+"""
+Cache of the DALI bus topology.
+
+Keeps the short addresses found on every bus, with the static data of each
+gear (device type, min and max level), in a small JSON file under the Home
+Assistant config dir, so entities can be created without scanning the bus.
+"""
+import logging
+import threading
+
+from homeassistant.exceptions import HomeAssistantError
+from homeassistant.util.json import load_json, save_json
+
+_LOGGER = logging.getLogger(__name__)
+
+TOPOLOGY_FILE = 'dali_topology.json'
+
+ATTR_DEVICE_TYPE = 'device_type'
+ATTR_MIN_LEVEL = 'min_level'
+ATTR_MAX_LEVEL = 'max_level'
+
+
+class TopologyCache(object):
+    """Gears of every bus, by bus index."""
+
+    def __init__(self, path):
+        """Load the cache from path."""
+        self._path = path
+        self._lock = threading.Lock()
+        try:
+            self._buses = load_json(path, default={})
+        except HomeAssistantError as err:
+            _LOGGER.warning("Ignoring DALI topology: %s", err)
+            self._buses = {}
+
+    def get(self, bus_index, name):
+        """Return {short address: static data} of a bus.
+
+        Returns:
+            dict, or None if the bus isn't cached or was renamed
+        """
+        with self._lock:
+            bus = self._buses.get(str(bus_index))
+        if bus is None or bus.get('name') != name:
+            return None
+        return {int(address): info
+                for address, info in bus.get('gears', {}).items()}
+
+    def set(self, bus_index, name, gears):
+        """Store the gears of a bus and write the cache."""
+        with self._lock:
+            self._buses[str(bus_index)] = {
+                'name': name,
+                'gears': {str(address): info
+                          for address, info in gears.items()},
+            }
+            try:
+                save_json(self._path, self._buses)
+            except Exception as err:
+                _LOGGER.error("Can't write DALI topology: %s", err)
@@ -1,40 +1,859 @@
-"""Filter helpers for Home Assistant."""
+"""Filter helpers for Home Assistant.
+
+The filters follow the semantics of the Home Assistant filter sensor, but
+keep their windows in fixed size ring buffers of doubles and pass a single
+slotted Sample through the filter instead of wrapping it in state objects.
+
+Every filter can also process whole arrays of samples at once through
+filter_array()/filter_history(), which require numpy.
+"""
 import logging
 import inspect
-
-from homeassistant.components.filter.sensor import (
-    OutlierFilter, LowPassFilter, ThrottleFilter,
-    TimeSMAFilter, FilterState)
-import homeassistant.util.dt as dt_util 
+import math
+import time
+import weakref
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
 
 FILTER_LOWPASS = 'lowpass'
 FILTER_OUTLIER = 'outlier'
 FILTER_TIME_SMA = 'time_sma'
 FILTER_THROTTLE = 'throttle'
+FILTER_MEDIAN = 'median'
+FILTER_EWMA = 'ewma'
+FILTER_HAMPEL = 'hampel'
+
+# scale of the median absolute deviation to a standard deviation
+MAD_SCALE = 1.4826
+
+# upper bounds, in microseconds, of the filter latency histogram buckets
+LATENCY_BUCKETS = (5, 10, 20, 50, 100, 200, 500, 1000)
+
+TIME_SMA_LAST = 'last'
+
+SAMPLE_ATTR = '_filter_sample'
+
+DEFAULT_MAX_IDLE = 6 * 3600  # seconds without samples before eviction
+DEFAULT_MAX_ENTITIES = 1024
+
+_STORES = weakref.WeakSet()
+
+
+def new_sample(sensor_object, timestamp=None):
+    """Signal that sensor_object has received a new raw sample.
+
+    Filters created with on_sample=True only run once per call to this
+    function, every other read of the property returns the cached value.
+
+    Args:
+        sensor_object: entity whose filtered properties should be updated
+        timestamp (float|datetime): time of the sample, defaults to now
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    elif isinstance(timestamp, datetime):
+        timestamp = timestamp.timestamp()
+    seq = getattr(sensor_object, SAMPLE_ATTR, (0, None))[0]
+    setattr(sensor_object, SAMPLE_ATTR, (seq + 1, timestamp))
+
+
+def forget(sensor_object):
+    """Drop the filter state kept for sensor_object (e.g. on removal)."""
+    for store in list(_STORES):
+        store.discard(sensor_object)
+
+
+def filter_stats(sensor_object, name):
+    """Return the counters of the filters of the name property.
+
+    Returns:
+        dict of FilterStats.as_dict() for sensor_object, None if the property
+        isn't filtered or sensor_object has no filter state yet
+    """
+    prop = getattr(type(sensor_object), name, None)
+    store = getattr(getattr(prop, 'fget', prop), 'filter_store', None)
+    return None if store is None else store.stats(sensor_object)
+
+
+def _round(value, precision):
+    """Round value the same way numpy.round does."""
+    if precision is None:
+        return value
+    scale = 10.0 ** precision
+    return round(value * scale) / scale
+
+
+def _linear_recurrence(np, coef, offset, initial):
+    """Solve y[i] = coef[i] * y[i-1] + offset[i] with y[-1] = initial.
+
+    Uses a parallel prefix scan of the affine maps, log2(n) vector steps.
+    """
+    coef = coef.copy()
+    offset = offset.copy()
+    shift = 1
+    while shift < len(coef):
+        offset[shift:] += coef[shift:] * offset[:-shift]
+        coef[shift:] *= coef[:-shift]
+        shift *= 2
+    return coef * initial + offset
+
+
+def filter_history(filters, timestamps, values):
+    """Filter whole arrays of samples at once.
+
+    The filters are applied in order, starting from an empty state, with
+    the same results as feeding the samples one by one through a fresh copy
+    of each filter. Samples rejected by a filter (throttle) keep the previous
+    filtered value, or NaN before the first one.
+
+    Args:
+        filters (list): configured filter instances, their state is not used
+        timestamps (array): epoch timestamps, in increasing order
+        values (array): numeric values
+
+    Returns:
+        numpy array of filtered values
+    """
+    import numpy as np
+
+    timestamps = np.asarray(timestamps, dtype=float)
+    values = np.asarray(values, dtype=float)
+    index = np.arange(len(values))
+    for filter_instance in filters:
+        values, passed = filter_instance.filter_array(timestamps[index],
+                                                      values)
+        values = values[passed]
+        index = index[passed]
+
+    result = np.full(len(timestamps), np.nan)
+    result[index] = values
+    # hold the last filtered value over rejected samples
+    held = np.zeros(len(timestamps), dtype=int)
+    held[index] = index
+    held = np.maximum.accumulate(held)
+    return np.where(np.isnan(result), result[held], result)
+
+
+def states_to_arrays(states, attribute=None):
+    """Convert Home Assistant states, e.g. recorder history, into arrays.
+
+    Args:
+        states (list): State objects in chronological order
+        attribute (string): attribute to use instead of the state
+
+    Returns:
+        (timestamps, values) numpy arrays, non numeric states are skipped
+    """
+    import numpy as np
+
+    timestamps = []
+    values = []
+    for state in states:
+        value = state.state if attribute is None \
+            else state.attributes.get(attribute)
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            continue
+        timestamps.append(state.last_updated.timestamp())
+        values.append(value)
+    return np.array(timestamps), np.array(values)
+
+
+class Sample(object):
+    """A single value and its epoch timestamp."""
+
+    __slots__ = ('timestamp', 'value')
+
+    def __init__(self, timestamp, value):
+        """Keep value and timestamp."""
+        self.timestamp = timestamp
+        self.value = value
+
+    def __repr__(self):
+        """Return the representation of the sample."""
+        return "Sample({}, {})".format(self.timestamp, self.value)
+
+
+class FilterStats(object):
+    """Counters and latency histogram of a filter."""
+
+    __slots__ = ('samples', 'outliers', 'throttled', 'errors', 'latency')
+
+    def __init__(self):
+        """Initialize every counter to zero."""
+        self.samples = self.outliers = self.throttled = self.errors = 0
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, seconds):
+        """Count a filter run of the given duration."""
+        self.latency[bisect_right(LATENCY_BUCKETS, seconds * 1e6)] += 1
+
+    def merge(self, other):
+        """Add the counters of other to these."""
+        self.samples += other.samples
+        self.outliers += other.outliers
+        self.throttled += other.throttled
+        self.errors += other.errors
+        self.latency = [mine + theirs for mine, theirs
+                        in zip(self.latency, other.latency)]
+
+    def as_dict(self):
+        """Return the counters, latency buckets keyed by upper bound."""
+        latency = {"<{}us".format(bound): count for bound, count
+                   in zip(LATENCY_BUCKETS, self.latency)}
+        latency[">{}us".format(LATENCY_BUCKETS[-1])] = self.latency[-1]
+        return {
+            'samples': self.samples,
+            'outliers': self.outliers,
+            'throttled': self.throttled,
+            'errors': self.errors,
+            'latency': latency,
+        }
+
+
+class RingBuffer(object):
+    """Fixed size ring buffer of (timestamp, value) pairs.
+
+    Timestamps and values are kept in two preallocated arrays of doubles, so
+    appending to a full buffer overwrites the oldest pair without allocating.
+    A growable buffer doubles its capacity instead of overwriting.
+    """
+
+    __slots__ = ('timestamps', 'values', 'capacity', 'growable',
+                 '_start', '_len')
+
+    def __init__(self, capacity, growable=False):
+        """Initialize an empty buffer of the given capacity."""
+        capacity = max(int(capacity), 1)
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.capacity = capacity
+        self.growable = growable
+        self._start = 0
+        self._len = 0
+
+    def __len__(self):
+        """Return the number of pairs stored."""
+        return self._len
+
+    @property
+    def full(self):
+        """Return True if the next append overwrites the oldest pair."""
+        return self._len == self.capacity
+
+    def clear(self):
+        """Drop every pair."""
+        self._start = self._len = 0
+
+    def _grow(self):
+        """Double the capacity, keeping the pairs in order."""
+        order = [(self._start + i) % self.capacity for i in range(self._len)]
+        self.timestamps = array('d', [self.timestamps[i] for i in order]) + \
+            array('d', bytes(8 * self.capacity))
+        self.values = array('d', [self.values[i] for i in order]) + \
+            array('d', bytes(8 * self.capacity))
+        self.capacity *= 2
+        self._start = 0
+
+    def append(self, timestamp, value):
+        """Append a pair, overwriting the oldest one if the buffer is full."""
+        if self._len == self.capacity:
+            if self.growable:
+                self._grow()
+            else:
+                self.timestamps[self._start] = timestamp
+                self.values[self._start] = value
+                self._start = (self._start + 1) % self.capacity
+                return
+        idx = (self._start + self._len) % self.capacity
+        self.timestamps[idx] = timestamp
+        self.values[idx] = value
+        self._len += 1
+
+    def popleft(self):
+        """Remove and return the oldest pair."""
+        if not self._len:
+            raise IndexError("pop from an empty RingBuffer")
+        idx = self._start
+        self._start = (self._start + 1) % self.capacity
+        self._len -= 1
+        return self.timestamps[idx], self.values[idx]
+
+    def timestamp(self, index):
+        """Return the timestamp at index, 0 being the oldest."""
+        return self.timestamps[(self._start + index % self._len) %
+                               self.capacity]
+
+    def value(self, index):
+        """Return the value at index, 0 being the oldest."""
+        return self.values[(self._start + index % self._len) % self.capacity]
+
+    def iter_values(self):
+        """Iterate over the values, oldest first."""
+        for i in range(self._len):
+            yield self.values[(self._start + i) % self.capacity]
+
+
+class SortedRingBuffer(RingBuffer):
+    """Ring buffer that also keeps its values sorted.
+
+    Appending costs a binary search plus a memmove of the sorted list, and
+    the median and median absolute deviation are O(1) and O(log n).
+    """
+
+    __slots__ = ('sorted',)
+
+    def __init__(self, capacity):
+        """Initialize an empty buffer of the given capacity."""
+        super().__init__(capacity)
+        self.sorted = []
+
+    def clear(self):
+        """Drop every pair."""
+        super().clear()
+        del self.sorted[:]
+
+    def append(self, timestamp, value):
+        """Append a pair, overwriting the oldest one if the buffer is full."""
+        if self.full:
+            del self.sorted[bisect_left(self.sorted, self.value(0))]
+        super().append(timestamp, value)
+        insort(self.sorted, value)
+
+    def popleft(self):
+        """Remove and return the oldest pair."""
+        pair = super().popleft()
+        del self.sorted[bisect_left(self.sorted, pair[1])]
+        return pair
+
+    def median(self):
+        """Return the median of the values."""
+        values = self.sorted
+        half = len(values) // 2
+        if len(values) % 2:
+            return values[half]
+        return (values[half - 1] + values[half]) / 2
+
+    def _kth_deviation(self, center, pivot, k):
+        """Return the k-th smallest |value - center|, 0 based.
+
+        Values below pivot give ascending deviations read right to left,
+        values from pivot on give ascending deviations left to right, so
+        this is a selection over two sorted sequences.
+        """
+        values = self.sorted
+        low = max(0, k + 1 - (len(values) - pivot))
+        high = min(k + 1, pivot)
+        while low < high:
+            taken = (low + high) // 2
+            # deviation of the next left value against the last right one
+            if center - values[pivot - 1 - taken] < \
+                    values[pivot + k - taken] - center:
+                low = taken + 1
+            else:
+                high = taken
+        deviation = None
+        if low > 0:
+            deviation = center - values[pivot - low]
+        if k + 1 - low > 0:
+            right = values[pivot + k - low] - center
+            if deviation is None or right > deviation:
+                deviation = right
+        return deviation
+
+    def mad(self, center=None):
+        """Return the median absolute deviation around center."""
+        if center is None:
+            center = self.median()
+        pivot = bisect_left(self.sorted, center)
+        half = len(self.sorted) // 2
+        if len(self.sorted) % 2:
+            return self._kth_deviation(center, pivot, half)
+        return (self._kth_deviation(center, pivot, half - 1) +
+                self._kth_deviation(center, pivot, half)) / 2
+
+
+class WindowFilter(object):
+    """Base filter, keeps the last window_size samples."""
+
+    name = None
+
+    def __init__(self, window_size=1, precision=None, entity=None):
+        """Initialize the window.
+
+        Args:
+            window_size (int): number of samples kept
+            precision (int): number of decimals of the filtered value
+            entity (string): name used in log messages
+        """
+        self.window = RingBuffer(window_size)
+        self.precision = precision
+        self.entity = entity
+        self.stats = FilterStats()
+        self._store_raw = False
+
+    def filter_sample(self, sample):
+        """Filter sample in place.
+
+        Returns the sample, or None if the filter rejected it.
+        """
+        raw = sample.value
+        if self._filter_sample(sample) is None:
+            return None
+        sample.value = _round(sample.value, self.precision)
+        self._store(sample, raw)
+        return sample
+
+    def _store(self, sample, raw):
+        """Keep the filtered sample, or its raw value, in the window."""
+        self.window.append(sample.timestamp,
+                           raw if self._store_raw else sample.value)
+
+    def _filter_sample(self, sample):
+        """Implement the filter."""
+        raise NotImplementedError()
+
+    def filter_array(self, timestamps, values):
+        """Filter numpy arrays of samples, starting from an empty window.
+
+        Returns:
+            (values, passed) arrays, passed is False for rejected samples
+        """
+        import numpy as np
+
+        filtered, passed = self._filter_array(np, timestamps, values)
+        if self.precision is not None:
+            filtered = np.round(filtered, self.precision)
+        return filtered, passed
+
+    def _filter_array(self, np, timestamps, values):
+        """Implement the filter on arrays."""
+        raise NotImplementedError()
+
+
+class LowPassFilter(WindowFilter):
+    """Exponential smoothing with a fixed weight per sample."""
+
+    name = FILTER_LOWPASS
+
+    def __init__(self, window_size, precision, entity, time_constant):
+        """Initialize the filter."""
+        super().__init__(window_size, precision, entity)
+        self._new_weight = 1.0 / time_constant
+        self._prev_weight = 1.0 - self._new_weight
+        self._state = None
+
+    def _filter_sample(self, sample):
+        """Blend the sample with the previous filtered value.
+
+        The filtered value is kept unrounded, precision only applies to
+        the output.
+        """
+        if self._state is not None:
+            sample.value = self._prev_weight * self._state + \
+                self._new_weight * sample.value
+        self._state = sample.value
+        return sample
+
+    def _filter_array(self, np, timestamps, values):
+        """Blend each sample with the previous filtered value."""
+        if not len(values):
+            return values.copy(), np.ones(0, dtype=bool)
+        coef = np.full(len(values) - 1, self._prev_weight)
+        offset = self._new_weight * values[1:]
+        filtered = np.empty(len(values))
+        filtered[0] = values[0]
+        filtered[1:] = _linear_recurrence(np, coef, offset, values[0])
+        return filtered, np.ones(len(values), dtype=bool)
+
+
+class OutlierFilter(WindowFilter):
+    """Replace samples far from the median of the last raw samples."""
+
+    name = FILTER_OUTLIER
+
+    def __init__(self, window_size, precision, entity, radius):
+        """Initialize the filter."""
+        super().__init__(window_size, precision, entity)
+        self.window = SortedRingBuffer(window_size)
+        self._radius = radius
+        self._store_raw = True
+
+    def _filter_sample(self, sample):
+        """Replace the sample by the median if it is an outlier."""
+        if self.window.full:
+            median = self.window.median()
+            if abs(sample.value - median) > self._radius:
+                self.stats.outliers += 1
+                sample.value = median
+        return sample
+
+    def _filter_array(self, np, timestamps, values):
+        """Replace the outliers by the median of the previous raw samples."""
+        size = self.window.capacity
+        filtered = values.copy()
+        if len(values) > size:
+            windows = np.lib.stride_tricks.sliding_window_view(
+                values[:-1], size)
+            medians = np.median(windows, axis=1)
+            outliers = np.abs(values[size:] - medians) > self._radius
+            filtered[size:][outliers] = medians[outliers]
+        return filtered, np.ones(len(values), dtype=bool)
+
+
+class MedianFilter(WindowFilter):
+    """Rolling median of the last window_size raw samples."""
+
+    name = FILTER_MEDIAN
+
+    def __init__(self, window_size, precision=None, entity=None):
+        """Initialize the filter."""
+        super().__init__(window_size, precision, entity)
+        self.window = SortedRingBuffer(window_size)
+
+    def _filter_sample(self, sample):
+        """Replace the sample by the median of the window including it."""
+        self.window.append(sample.timestamp, sample.value)
+        sample.value = self.window.median()
+        return sample
+
+    def _store(self, sample, raw):
+        """Raw value is already in the window."""
+
+    def _filter_array(self, np, timestamps, values):
+        """Compute the median of each window."""
+        size = self.window.capacity
+        filtered = np.empty(len(values))
+        for i in range(min(size - 1, len(values))):
+            filtered[i] = np.median(values[:i + 1])
+        if len(values) >= size:
+            windows = np.lib.stride_tricks.sliding_window_view(values, size)
+            filtered[size - 1:] = np.median(windows, axis=1)
+        return filtered, np.ones(len(values), dtype=bool)
+
+
+class HampelFilter(WindowFilter):
+    """Replace samples more than n_sigmas robust deviations from the median.
+
+    The deviation is estimated from the median absolute deviation of the
+    last window_size raw samples.
+    """
+
+    name = FILTER_HAMPEL
+
+    def __init__(self, window_size, precision=None, entity=None,
+                 n_sigmas=3.0):
+        """Initialize the filter."""
+        super().__init__(window_size, precision, entity)
+        self.window = SortedRingBuffer(window_size)
+        self._n_sigmas = n_sigmas
+        self._store_raw = True
+
+    def _filter_sample(self, sample):
+        """Replace the sample by the median if it is an outlier."""
+        if self.window.full:
+            median = self.window.median()
+            threshold = self._n_sigmas * MAD_SCALE * self.window.mad(median)
+            if abs(sample.value - median) > threshold:
+                self.stats.outliers += 1
+                sample.value = median
+        return sample
+
+    def _filter_array(self, np, timestamps, values):
+        """Replace the outliers by the median of the previous raw samples."""
+        size = self.window.capacity
+        filtered = values.copy()
+        if len(values) > size:
+            windows = np.lib.stride_tricks.sliding_window_view(
+                values[:-1], size)
+            medians = np.median(windows, axis=1)
+            mads = np.median(np.abs(windows - medians[:, None]), axis=1)
+            threshold = self._n_sigmas * MAD_SCALE * mads
+            outliers = np.abs(values[size:] - medians) > threshold
+            filtered[size:][outliers] = medians[outliers]
+        return filtered, np.ones(len(values), dtype=bool)
+
+
+class EWMAFilter(WindowFilter):
+    """Exponentially weighted moving average aware of sample spacing.
+
+    The weight of the previous value decays as exp(-dt / time_constant), so
+    the result does not depend on how often the sensor reports.
+    """
+
+    name = FILTER_EWMA
+
+    def __init__(self, window_size=1, precision=None, entity=None,
+                 time_constant=60):
+        """Initialize the filter.
+
+        Args:
+            time_constant (timedelta|float): seconds if a number
+        """
+        super().__init__(window_size, precision, entity)
+        if isinstance(time_constant, timedelta):
+            time_constant = time_constant.total_seconds()
+        self._time_constant = float(time_constant)
+        self._state = None
+        self._timestamp = None
+
+    def _filter_sample(self, sample):
+        """Blend the sample with the previous filtered value."""
+        if self._state is not None:
+            decay = math.exp(
+                -max(sample.timestamp - self._timestamp, 0.0) /
+                self._time_constant)
+            sample.value = decay * self._state + (1.0 - decay) * sample.value
+        self._state = sample.value
+        self._timestamp = sample.timestamp
+        return sample
+
+    def _filter_array(self, np, timestamps, values):
+        """Blend each sample with the previous filtered value."""
+        if not len(values):
+            return values.copy(), np.ones(0, dtype=bool)
+        decay = np.exp(-np.maximum(np.diff(timestamps), 0.0) /
+                       self._time_constant)
+        filtered = np.empty(len(values))
+        filtered[0] = values[0]
+        filtered[1:] = _linear_recurrence(np, decay, (1.0 - decay) *
+                                          values[1:], values[0])
+        return filtered, np.ones(len(values), dtype=bool)
+
+
+class TimeSMAFilter(WindowFilter):
+    """Time weighted simple moving average over a time window."""
+
+    name = FILTER_TIME_SMA
+
+    def __init__(self, window_size, precision, entity, type=TIME_SMA_LAST):
+        """Initialize the filter.
+
+        Args:
+            window_size (timedelta|float): time window, seconds if a number
+            type (string): only 'last' is supported
+        """
+        super().__init__(1, precision, entity)
+        if isinstance(window_size, timedelta):
+            window_size = window_size.total_seconds()
+        self._time_window = float(window_size)
+        self._queue = RingBuffer(8, growable=True)
+        self._last_leak = None
+
+    def _filter_sample(self, sample):
+        """Average the held values over the time window."""
+        start = sample.timestamp - self._time_window
+        queue = self._queue
+        while queue and queue.timestamp(0) <= start:
+            self._last_leak = queue.popleft()[1]
+        queue.append(sample.timestamp, sample.value)
+
+        prev = self._last_leak if self._last_leak is not None \
+            else queue.value(0)
+        moving_sum = 0.0
+        for i in range(len(queue)):
+            timestamp = queue.timestamp(i)
+            moving_sum += (timestamp - start) * prev
+            start = timestamp
+            prev = queue.value(i)
+        sample.value = moving_sum / self._time_window
+        return sample
+
+    def _filter_array(self, np, timestamps, values):
+        """Integrate the held values over the time window of each sample."""
+        if not len(values):
+            return values.copy(), np.ones(0, dtype=bool)
+        # integral of the held values from the first sample to each sample
+        integral = np.zeros(len(values))
+        np.cumsum(values[:-1] * np.diff(timestamps), out=integral[1:])
+        start = timestamps - self._time_window
+        # sample held at the start of each window, the first one before it
+        held = np.maximum(
+            np.searchsorted(timestamps, start, side='right') - 1, 0)
+        integral_start = integral[held] + \
+            values[held] * (start - timestamps[held])
+        filtered = (integral - integral_start) / self._time_window
+        return filtered, np.ones(len(values), dtype=bool)
+
+
+class ThrottleFilter(WindowFilter):
+    """Only let one in every window_size samples through."""
+
+    name = FILTER_THROTTLE
+
+    def __init__(self, window_size, precision=None, entity=None):
+        """Initialize the filter."""
+        super().__init__(window_size, precision, entity)
+
+    def _filter_sample(self, sample):
+        """Reject the sample unless a new window starts."""
+        if self.window and not self.window.full:
+            self.window.append(sample.timestamp, sample.value)
+            self.stats.throttled += 1
+            return None
+        self.window.clear()
+        return sample
+
+    def _filter_array(self, np, timestamps, values):
+        """Let the first of every window_size samples through."""
+        passed = np.arange(len(values)) % self.window.capacity == 0
+        return values.copy(), passed
+
 
 FILTERS = {
     FILTER_LOWPASS: LowPassFilter,
     FILTER_OUTLIER: OutlierFilter,
-    FILTER_TIME_SMA: TimeSMAFilter, 
-    FILTER_THROTTLE: ThrottleFilter
+    FILTER_TIME_SMA: TimeSMAFilter,
+    FILTER_THROTTLE: ThrottleFilter,
+    FILTER_MEDIAN: MedianFilter,
+    FILTER_EWMA: EWMAFilter,
+    FILTER_HAMPEL: HampelFilter,
     }
 
-class FakeState(object):
-    """Fake HA state."""
-    def __init__(self, value):
-        """Keep value and timestamp."""
-        self.last_updated = dt_util.utcnow() 
-        self.state = value
+
+class Pipeline(object):
+    """Chain of filters run in a single pass over one sample."""
+
+    __slots__ = ('filters', 'stats')
+
+    def __init__(self, filters):
+        """Initialize the pipeline with filter instances, in order.
+
+        All filters report to the stats of the pipeline.
+        """
+        self.filters = tuple(filters)
+        self.stats = FilterStats()
+        for filter_instance in self.filters:
+            filter_instance.stats = self.stats
+
+    def filter_sample(self, sample):
+        """Run sample through every filter, stopping at the first reject."""
+        self.stats.samples += 1
+        for filter_instance in self.filters:
+            if filter_instance.filter_sample(sample) is None:
+                return None
+        return sample
+
+    def filter_array(self, timestamps, values):
+        """Filter numpy arrays of samples, see filter_history()."""
+        import numpy as np
+
+        filtered = filter_history(self.filters, timestamps, values)
+        return filtered, ~np.isnan(filtered)
+
+
+class _FilterEntry(object):
+    """Filter state of a single entity."""
+
+    __slots__ = ('filter', 'seq', 'value', 'last_used', 'ref')
+
+    def __init__(self, filter_instance, ref):
+        """Initialize an empty entry, ref is a weak reference to the entity."""
+        self.filter = filter_instance
+        self.ref = ref
+        self.seq = None
+        self.value = None
+        self.last_used = time.monotonic()
+
+
+class FilterStore(object):
+    """Filter state kept per entity, least recently used first.
+
+    Entries are dropped when the entity is garbage collected, when they have
+    not been used for max_idle seconds or when the store holds more than
+    max_entities entries. Entries are keyed by id(), as entities define
+    __eq__ and aren't hashable.
+    """
+
+    def __init__(self, factory, max_idle=DEFAULT_MAX_IDLE,
+                 max_entities=DEFAULT_MAX_ENTITIES):
+        """Initialize the store.
+
+        Args:
+            factory (callable): returns a new filter instance
+            max_idle (float): seconds an entry may stay unused
+            max_entities (int): maximum number of entries
+        """
+        self._factory = factory
+        self._max_idle = max_idle
+        self._max_entities = max_entities
+        self._entries = OrderedDict()
+        _STORES.add(self)
+
+    def __len__(self):
+        """Return the number of entities tracked."""
+        return len(self._entries)
+
+    def _remove(self, key, ref):
+        """Drop the entry of a garbage collected entity."""
+        entry = self._entries.get(key)
+        if entry is not None and entry.ref is ref:
+            del self._entries[key]
+
+    def get(self, sensor_object):
+        """Return the entry of sensor_object, creating it if needed."""
+        now = time.monotonic()
+        key = id(sensor_object)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _FilterEntry(
+                self._factory(),
+                weakref.ref(sensor_object,
+                            lambda ref: self._remove(key, ref)))
+        else:
+            self._entries.move_to_end(key)
+        entry.last_used = now
+        self.evict(now)
+        return entry
+
+    def stats(self, sensor_object=None):
+        """Return the counters of sensor_object, or of every entity."""
+        if sensor_object is not None:
+            entry = self._entries.get(id(sensor_object))
+            return None if entry is None else entry.filter.stats.as_dict()
+        stats = FilterStats()
+        for entry in self._entries.values():
+            stats.merge(entry.filter.stats)
+        return stats.as_dict()
+
+    def discard(self, sensor_object):
+        """Drop the entry of sensor_object."""
+        self._entries.pop(id(sensor_object), None)
+
+    def evict(self, now=None):
+        """Drop idle entries and enforce the maximum number of entries."""
+        if now is None:
+            now = time.monotonic()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if len(self._entries) <= self._max_entities and \
+                    now - entry.last_used <= self._max_idle:
+                break
+            del self._entries[key]
+
 
 class Filter(object):
     """Filter decorator."""
 
-    def __init__(self, filter_algorithm, **kwargs):
+    def __init__(self, filter_algorithm, on_sample=False,
+                 max_idle=DEFAULT_MAX_IDLE, **kwargs):
         """Decorator constructor, selects algorithm and configures window.
 
+        Each decorated entity gets its own filter instance. Stacked Filter
+        decorators are fused into a single Pipeline, run from the innermost
+        to the outermost filter, and the outermost decorator settings
+        (on_sample, max_idle) apply to the whole pipeline.
+
         Args:
             filter_algorithm (string): must be one of the defined filters
+            on_sample (bool): filter once per new_sample() instead of on
+                every read of the decorated property
+            max_idle (float): seconds after which the filter state of an
+                entity that stopped reporting is dropped
             kwargs (dict): arguments to be passed to the specific filter
         """
         try:
@@ -45,23 +864,82 @@ class Filter(object):
         except:
             Filter.logger = logging.getLogger("custom_components")
 
+        self.on_sample = on_sample
+        self.max_idle = max_idle
+        self.kwargs = kwargs
+        self.algorithm = None
+        self.store = None
+
         if filter_algorithm in FILTERS:
-            self.filter = FILTERS[filter_algorithm](**kwargs)
+            self.algorithm = FILTERS[filter_algorithm]
         else:
             self.logger.error("Unknown filter <%s>", filter_algorithm)
 
+    def _filter(self, sensor_object, entry, value, timestamp=None):
+        """Run value through the filter of sensor_object.
+
+        A sample rejected by the filter keeps the previous filtered value.
+        """
+        stats = entry.filter.stats
+        try:
+            sample = Sample(timestamp or time.time(), float(value))
+        except (TypeError, ValueError):
+            stats.errors += 1
+            return None
+
+        start = time.perf_counter()
+        filtered = entry.filter.filter_sample(sample)
+        stats.record(time.perf_counter() - start)
+        if filtered is None:
+            return entry.value
+
+        Filter.logger.debug("%s(%s) -> %s", sensor_object.entity_id,
+                            value, sample.value)
+        return sample.value
+
     def __call__(self, func):
         """Decorate function as filter."""
+        stages = [self]
+        if hasattr(func, 'filter_stages'):
+            # fuse with the Filter decorators below this one
+            stages = func.filter_stages + stages
+            func = func.__wrapped__
+            for stage in stages:
+                stage.store = None
+        algorithms = [(stage.algorithm, stage.kwargs) for stage in stages
+                      if stage.algorithm is not None]
+
+        if algorithms:
+            self.store = FilterStore(
+                lambda: Pipeline(algorithm(**kwargs)
+                                 for algorithm, kwargs in algorithms),
+                self.max_idle)
+
         def func_wrapper(sensor_object):
             """Wrap for the original state() function."""
-            new_state = FakeState(func(sensor_object))
-            try:
-                filtered_state = self.filter.filter_state(new_state)
-            except TypeError:
-                return None
+            if self.store is None:
+                return func(sensor_object)
+
+            entry = self.store.get(sensor_object)
+            if not self.on_sample:
+                entry.value = self._filter(sensor_object, entry,
+                                           func(sensor_object))
+                return entry.value
+
+            seq, timestamp = getattr(sensor_object, SAMPLE_ATTR, (0, None))
+            if entry.seq == seq:
+                return entry.value
 
-            Filter.logger.debug("%s(%s) -> %s", sensor_object.entity_id,
-                                new_state.state, filtered_state.state)
-            return filtered_state.state
+            if seq == 0:
+                # No sample has been signaled yet, nothing to filter
+                entry.value = func(sensor_object)
+            else:
+                entry.value = self._filter(sensor_object, entry,
+                                           func(sensor_object), timestamp)
+            entry.seq = seq
+            return entry.value
 
+        func_wrapper.filter_stages = stages
+        func_wrapper.filter_store = self.store
+        func_wrapper.__wrapped__ = func
         return func_wrapper
@@ -5,7 +5,7 @@ https://github.com/dgomes/homeGW
 """
 import asyncio
 import logging
-import json
+import time
 import voluptuous as vol
 
 from homeassistant.components.climate import (
@@ -22,61 +22,137 @@ import homeassistant.helpers.config_validation as cv
 import os
 import sys
 sys.path.append(os.sep.join(os.path.abspath(__file__).split(os.sep)[:-2]))
-from filter_helper import Filter, FILTER_OUTLIER, FILTER_LOWPASS
+from filter_helper import (
+    Filter, new_sample, forget, filter_stats, FILTER_OUTLIER, FILTER_LOWPASS)
+
+from .duty_cycle import DutyCycle
+from .hub import async_get_hub, DEFAULT_DEDUP_WINDOW, DEFAULT_IDLE_TIMEOUT
+from .store import async_get_store
 
 _LOGGER = logging.getLogger(__name__)
 
 SUPPORT_FLAGS = SUPPORT_TARGET_HUMIDITY_LOW
 
 CONF_SERIAL_ENTITY = 'serial_sensor'
+CONF_MQTT_TOPIC = 'mqtt_topic'
+CONF_DEDUP_WINDOW = 'dedup_window'
 CONF_HEATING_ENTITY = 'heating_sensor'
 CONF_DEV_CHANNEL = 'channel'
 CONF_TARGET_TEMP = 'target_temp'
+CONF_DISCOVERY = 'discovery'
+CONF_IDLE_TIMEOUT = 'idle_timeout'
+CONF_HISTORY = 'history'
 
-ATTR_HOMEGW_DEV = 'dev'
-ATTR_HOMEGW_TEMPERATURE = 'temp'
-ATTR_HOMEGW_HUMIDITY = 'hum'
 ATTR_HOMEGW_ID = 'id'
 ATTR_HOMEGW_CHANNEL = 'ch'
 ATTR_HOMEGW_BATTERY = 'batt'
+ATTR_OUTLIERS = '{}_outliers'
+ATTR_HEATING_DUTY_CYCLE = 'heating_duty_cycle_{}'
+ATTR_HEATING_OBSERVED = 'heating_observed'
+
+# Windows of the heating duty cycle, in seconds
+DUTY_CYCLE_WINDOWS = {
+    '1h': 3600,
+    '24h': 24 * 3600,
+    '7d': 7 * 24 * 3600,
+}
 
 DEFAULT_NAME = "HomeGW thermostat"
 
+DATA_HOMEGW_DISCOVERY = 'homegw_climate_discovery'
+
 VALUE_HOMEGW_DEV_DIGOO = 'digoo'
 
-PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
-    vol.Required(CONF_SERIAL_ENTITY): cv.entity_id,
-    vol.Required(CONF_DEV_CHANNEL): cv.positive_int,
+PLATFORM_SCHEMA = vol.All(PLATFORM_SCHEMA.extend({
+    vol.Exclusive(CONF_SERIAL_ENTITY, 'source'): cv.entity_id,
+    vol.Exclusive(CONF_MQTT_TOPIC, 'source'): cv.string,
+    vol.Optional(CONF_DEDUP_WINDOW, default=DEFAULT_DEDUP_WINDOW):
+        cv.positive_int,
+    vol.Optional(CONF_DEV_CHANNEL): cv.positive_int,
+    vol.Optional(CONF_DISCOVERY, default=False): cv.boolean,
+    vol.Optional(CONF_IDLE_TIMEOUT, default=DEFAULT_IDLE_TIMEOUT):
+        cv.positive_int,
     vol.Optional(CONF_HEATING_ENTITY): cv.entity_id,
+    vol.Optional(CONF_HISTORY, default=True): cv.boolean,
     vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
     vol.Optional(CONF_TARGET_TEMP): vol.Coerce(float),
-})
+}), cv.has_at_least_one_key(CONF_SERIAL_ENTITY, CONF_MQTT_TOPIC))
 
 
 @asyncio.coroutine
 def async_setup_platform(hass, config, async_add_devices, discovery_info=None):
     """Set up homeGW climate devices."""
-    serial_sensor = config[CONF_SERIAL_ENTITY]
-    dev_channel = config[CONF_DEV_CHANNEL]
+    hub = yield from async_get_hub(hass, config.get(CONF_SERIAL_ENTITY),
+                                   config.get(CONF_MQTT_TOPIC),
+                                   config[CONF_DEDUP_WINDOW],
+                                   config[CONF_IDLE_TIMEOUT])
+    dev_channel = config.get(CONF_DEV_CHANNEL)
     heating_sensor = config.get(CONF_HEATING_ENTITY)
     name = config.get(CONF_NAME, DEFAULT_NAME)
     target_temp = config.get(CONF_TARGET_TEMP)
+    store = async_get_store(hass) if config[CONF_HISTORY] else None
+
+    if dev_channel is not None:
+        async_add_devices([
+            HomeGWClimate(hass, name, hub, store,
+                          heating_sensor, dev_channel, target_temp)
+        ])
+
+    if not config[CONF_DISCOVERY]:
+        if dev_channel is None:
+            _LOGGER.error("Either %s or %s must be set",
+                          CONF_DEV_CHANNEL, CONF_DISCOVERY)
+        return
+
+    # one discovery listener per hub, whichever entry enables it first
+    hubs = hass.data.setdefault(DATA_HOMEGW_DISCOVERY, set())
+    if hub in hubs:
+        _LOGGER.warning("Discovery is already enabled for this gateway")
+        return
+    hubs.add(hub)
+    discovered = {}
+
+    @callback
+    def async_new_device(reading):
+        """Add a thermostat for a device heard for the first time."""
+        device = (reading.dev, reading.id, reading.channel)
+        entity = HomeGWClimate(
+            hass, "{} {} {}".format(name, reading.channel, reading.id), hub,
+            store, None, reading.channel, None, reading.id, reading)
+        discovered[device] = entity
+        async_add_devices([entity])
+
+    @callback
+    def async_device_idle(device):
+        """Remove the thermostat of an idle device."""
+        entity = discovered.pop(device, None)
+        if entity is not None:
+            hass.async_create_task(entity.async_remove())
 
-    async_add_devices([
-        HomeGWClimate(hass, name, serial_sensor,
-                      heating_sensor, dev_channel, target_temp)
-    ])
+    hub.async_listen_discovery(VALUE_HOMEGW_DEV_DIGOO, async_new_device,
+                               async_device_idle)
 
 
 class HomeGWClimate(ClimateDevice):
     """Representation of a demo climate device."""
 
-    def __init__(self, hass, name, serial_sensor,
-                 heating_sensor, dev_channel, target_temp):
-        """Initialize the climate device."""
+    def __init__(self, hass, name, hub, store, heating_sensor, dev_channel,
+                 target_temp, device_id=None, reading=None):
+        """Initialize the climate device.
+
+        A discovered device is bound to its device_id, and reading is the
+        packet it was discovered with. Readings are recorded in store,
+        unless it is None.
+        """
         self._name = name
+        self._hub = hub
+        self._store = store
+        self._series = None
+        self._unregister = None
         self._channel = dev_channel
-        self._id = None
+        self._device_id = device_id
+        self._reading = reading
+        self._id = device_id
         self._battery = None
         self._unit_of_measurement = TEMP_CELSIUS
         self._support_flags = SUPPORT_FLAGS
@@ -88,12 +164,21 @@ class HomeGWClimate(ClimateDevice):
         self._humidity = None
         self._target_humidity = 50
 
-        async_track_state_change(hass, serial_sensor, self._sensor_changed)
-        async_track_state_change(hass, heating_sensor, self._heating_changed)
+        self._heating_sensor = heating_sensor
+        self._unregister_heating = None
+        self._duty_cycle = None
+        if heating_sensor is not None:
+            self._duty_cycle = DutyCycle(DUTY_CYCLE_WINDOWS.values(),
+                                         time.monotonic())
 
     @asyncio.coroutine
     def async_added_to_hass(self):
         """Run when entity about to be added."""
+        if self._store is not None:
+            self._series = self._store.series(self.entity_id)
+        self._unregister = self._hub.async_register(
+            self._sensor_changed, VALUE_HOMEGW_DEV_DIGOO, self._channel,
+            self._device_id)
         old_state = yield from async_get_last_state(self.hass, self.entity_id)
         if old_state is not None:
             _LOGGER.debug("Loading %s old_state: %s",
@@ -104,6 +189,52 @@ class HomeGWClimate(ClimateDevice):
             if old_state.attributes.get(ATTR_CURRENT_HUMIDITY):
                 self._current_humidity = int(
                     old_state.attributes[ATTR_CURRENT_HUMIDITY])
+            if self._duty_cycle is not None and \
+                    old_state.attributes.get(ATTR_HEATING_OBSERVED):
+                self._restore_duty_cycle(
+                    old_state.attributes,
+                    old_state.last_updated.timestamp())
+        if self._heating_sensor is not None:
+            state = self.hass.states.get(self._heating_sensor)
+            if state is not None and state.state == STATE_ON:
+                self._current_operation = STATE_HEAT
+                self._duty_cycle.set_state(True, time.monotonic())
+            self._unregister_heating = async_track_state_change(
+                self.hass, self._heating_sensor, self._heating_changed)
+        if self._reading is not None:
+            self._sensor_changed(self._reading)
+            self._reading = None
+
+    @asyncio.coroutine
+    def async_will_remove_from_hass(self):
+        """Stop receiving packets and drop the filter state."""
+        if self._unregister is not None:
+            self._unregister()
+            self._unregister = None
+        if self._unregister_heating is not None:
+            self._unregister_heating()
+            self._unregister_heating = None
+        forget(self)
+
+    def _restore_duty_cycle(self, attributes, last_updated):
+        """Resume the duty cycle from the heating attributes.
+
+        The on time of a window is its duty cycle of the time observed.
+        """
+        try:
+            observed = float(attributes[ATTR_HEATING_OBSERVED])
+            on_times = {
+                window: float(attributes[ATTR_HEATING_DUTY_CYCLE.format(
+                    name)]) / 100 * min(window, observed)
+                for name, window in DUTY_CYCLE_WINDOWS.items()
+                if ATTR_HEATING_DUTY_CYCLE.format(name) in attributes}
+        except (TypeError, ValueError):
+            _LOGGER.warning("Ignoring heating duty cycle of %s",
+                            self.entity_id)
+            return
+        # the snapshot on the monotonic clock of the duty cycle
+        timestamp = time.monotonic() - (time.time() - last_updated)
+        self._duty_cycle.restore(on_times, observed, timestamp)
 
     @callback
     def _heating_changed(self, entity_id, old_state, new_state):
@@ -117,37 +248,37 @@ class HomeGWClimate(ClimateDevice):
             self._current_operation = STATE_HEAT 
         else:
             self._current_operation = STATE_IDLE
+        self._duty_cycle.set_state(new_state.state == STATE_ON,
+                                   time.monotonic())
         self.schedule_update_ha_state()
 
     @callback
-    def _sensor_changed(self, entity_id, old_state, new_state):
-        """Handle sensor state changes."""
-        if new_state is None:
-            return
-        elif new_state.state == STATE_UNKNOWN:
-            return
-
-        try:
-            payload = json.loads(new_state.state)
-        except Exception:
-            _LOGGER.warning("Could not process: %s", new_state.state)
-            return
-
-        if payload[ATTR_HOMEGW_DEV] != VALUE_HOMEGW_DEV_DIGOO:
-            return
-        if payload[ATTR_HOMEGW_CHANNEL] != self._channel:
-            return
-
-        _LOGGER.debug("%s : %s", self._channel, new_state.state)
-
-        self._current_temperature = float(payload[ATTR_HOMEGW_TEMPERATURE])
-        self._current_humidity = int(payload[ATTR_HOMEGW_HUMIDITY])
-        self._id = int(payload[ATTR_HOMEGW_ID])
-        self._channel = int(payload[ATTR_HOMEGW_CHANNEL])
-        self._battery = bool(payload[ATTR_HOMEGW_BATTERY])
+    def _sensor_changed(self, reading):
+        """Handle a packet of this channel."""
+        _LOGGER.debug("%s : %s", self._channel, reading)
+
+        self._current_temperature = reading.temperature
+        self._current_humidity = reading.humidity
+        self._id = reading.id
+        self._channel = reading.channel
+        self._battery = reading.battery
+
+        new_sample(self)
+        temperature = self.current_temperature
+        humidity = self.current_humidity
+        if self._series is not None:
+            self._series.append(time.time(), temperature, humidity)
 
         self.schedule_update_ha_state()
 
+    @property
+    def unique_id(self):
+        """Return the id of a discovered device, None if configured."""
+        if self._device_id is None:
+            return None
+        return "homegw_{}_{}_{}".format(VALUE_HOMEGW_DEV_DIGOO,
+                                        self._device_id, self._channel)
+
     @property
     def force_update(self):
         """Force update on new state values."""
@@ -174,9 +305,9 @@ class HomeGWClimate(ClimateDevice):
         return self._unit_of_measurement
 
     @property
-    @Filter(FILTER_LOWPASS,
+    @Filter(FILTER_LOWPASS, on_sample=True,
             window_size=1, precision=1, entity="temperature",time_constant=8)
-    @Filter(FILTER_OUTLIER,
+    @Filter(FILTER_OUTLIER, on_sample=True,
             window_size=3, precision=2, entity="temperature", radius=2.0)
     def current_temperature(self):
         """Return the current temperature."""
@@ -188,9 +319,9 @@ class HomeGWClimate(ClimateDevice):
         return 21.0
 
     @property
-    @Filter(FILTER_LOWPASS,
+    @Filter(FILTER_LOWPASS, on_sample=True,
             window_size=1, precision=1, entity="unnamed",time_constant=4)
-    @Filter(FILTER_OUTLIER,
+    @Filter(FILTER_OUTLIER, on_sample=True,
             window_size=3, precision=2, entity="unnamed", radius=3.0)
     def current_humidity(self):
         """Return the current humidity."""
@@ -214,4 +345,19 @@ class HomeGWClimate(ClimateDevice):
             attrs[ATTR_HOMEGW_ID] = self._id
         if self._battery is not None:
             attrs[ATTR_HOMEGW_BATTERY] = self._battery
+        for quantity in ('temperature', 'humidity'):
+            stats = filter_stats(self, 'current_' + quantity)
+            if stats is not None:
+                attrs[ATTR_OUTLIERS.format(quantity)] = stats['outliers']
+        if self._duty_cycle is not None:
+            now = time.monotonic()
+            for name, window in DUTY_CYCLE_WINDOWS.items():
+                duty_cycle = self._duty_cycle.duty_cycle(window, now)
+                if duty_cycle is not None:
+                    attrs[ATTR_HEATING_DUTY_CYCLE.format(name)] = round(
+                        duty_cycle * 100, 1)
+            # restored on startup with the duty cycles, the duty cycle log
+            # isn't persisted
+            _, observed = self._duty_cycle.snapshot(now)
+            attrs[ATTR_HEATING_OBSERVED] = round(observed)
         return attrs
@@ -5,56 +5,88 @@ For more details about this platform, please refer to the documentation
 https://github.com/dgomes/home_mqtt
 """
 import logging
+import statistics
+import time
 
 import voluptuous as vol
 
-from homeassistant.util import dt as dt_util
 from homeassistant.core import callback
 from homeassistant.components.cover import (
     CoverEntity, PLATFORM_SCHEMA,
     ATTR_POSITION)
-from homeassistant.const import (STATE_OPEN, STATE_CLOSED,
+from homeassistant.const import (STATE_OPEN, STATE_CLOSED, ATTR_ENTITY_ID,
     CONF_COVERS, CONF_DELAY_TIME, CONF_FRIENDLY_NAME)
 from homeassistant.helpers.event import track_utc_time_change
 from homeassistant.components import mqtt
 from homeassistant.helpers.restore_state import RestoreEntity 
 import homeassistant.helpers.config_validation as cv
 
+from .m_duino import async_get_relays, PAYLOAD_OFF, DEFAULT_STAGGER
+
 DEPENDENCIES = ['mqtt']
 
 _LOGGER = logging.getLogger(__name__)
 
 CONF_RELAY_UP = "relay_up"
 CONF_RELAY_DOWN = "relay_down"
+CONF_UP_TIME = "up_time"
+CONF_DOWN_TIME = "down_time"
+CONF_GROUPS = "groups"
+CONF_STAGGER = "stagger"
+
+RELAY_TIMEOUT = 30  # seconds a relay may take beyond its run to report
+UPDATE_INTERVAL = 1  # seconds between position updates of a moving cover
+
+DOMAIN = 'homegw'
+DATA_COVERS = 'homegw_covers'
+SERVICE_SET_COVERS_POSITION = 'set_covers_position'
 
 ICON_OPEN = "mdi:blinds-open"
 ICON_CLOSE = "mdi:blinds"
 
-M_DUINO_RELAY = "devices/m-duino/relay/{}"
-M_DUINO_RELAY_SET = M_DUINO_RELAY + "/set"
+DIRECTION_UP = 'up'
+DIRECTION_DOWN = 'down'
 
 COVER_SCHEMA = vol.Schema({
     vol.Required(CONF_RELAY_UP): cv.positive_int,
     vol.Required(CONF_RELAY_DOWN): cv.positive_int,
     vol.Optional(CONF_DELAY_TIME, default=30000): cv.positive_int,
+    vol.Optional(CONF_UP_TIME): cv.positive_int,
+    vol.Optional(CONF_DOWN_TIME): cv.positive_int,
+})
+
+GROUP_SCHEMA = vol.Schema({
+    vol.Required(CONF_COVERS): vol.All(cv.ensure_list, [cv.slug]),
+    vol.Optional(CONF_FRIENDLY_NAME): cv.string,
 })
 
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Required(CONF_COVERS): vol.Schema({cv.slug: COVER_SCHEMA}),
+    vol.Optional(CONF_GROUPS, default={}): vol.Schema({cv.slug: GROUP_SCHEMA}),
+    vol.Optional(CONF_STAGGER, default=DEFAULT_STAGGER): cv.positive_int,
+})
+
+SET_COVERS_POSITION_SCHEMA = vol.Schema({
+    vol.Optional(ATTR_ENTITY_ID): cv.entity_ids,
+    vol.Required(ATTR_POSITION):
+        vol.All(vol.Coerce(int), vol.Range(min=0, max=100)),
 })
 
 
 async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
     """Set up the covers."""
-    covers = []
+    relays = await async_get_relays(hass, config[CONF_STAGGER])
+    covers = {}
     for cover_name, cover_config in config.get(CONF_COVERS, {}).items():
-        covers.append(
+        covers[cover_name] = (
             HomeMQTTCover(
                 hass,
+                relays,
                 cover_name,
                 cover_config[CONF_RELAY_UP],
                 cover_config[CONF_RELAY_DOWN],
-                cover_config[CONF_DELAY_TIME]
+                cover_config.get(CONF_UP_TIME, cover_config[CONF_DELAY_TIME]),
+                cover_config.get(CONF_DOWN_TIME, cover_config[CONF_DELAY_TIME])
             )
         )
 
@@ -62,25 +94,70 @@ async def async_setup_platform(hass, config, async_add_entities, discovery_info=
         _LOGGER.error("No covers added")
         return
 
-    async_add_entities(covers)
+    groups = []
+    for group_name, group_config in config[CONF_GROUPS].items():
+        missing = set(group_config[CONF_COVERS]) - set(covers)
+        if missing:
+            _LOGGER.error("Group %s has unknown covers: %s",
+                          group_name, ", ".join(sorted(missing)))
+            continue
+        groups.append(HomeMQTTCoverGroup(
+            group_config.get(CONF_FRIENDLY_NAME, group_name),
+            [covers[name] for name in group_config[CONF_COVERS]]))
+
+    async_add_entities(list(covers.values()) + groups)
+
+    if DATA_COVERS not in hass.data:
+        hass.data[DATA_COVERS] = []
+
+        async def async_set_covers_position(call):
+            """Move covers, all of them by default, to a position."""
+            entity_ids = call.data.get(ATTR_ENTITY_ID)
+            for cover in hass.data[DATA_COVERS]:
+                if entity_ids is None or cover.entity_id in entity_ids:
+                    await cover.async_set_cover_position(
+                        position=call.data[ATTR_POSITION])
+
+        hass.services.async_register(
+            DOMAIN, SERVICE_SET_COVERS_POSITION, async_set_covers_position,
+            schema=SET_COVERS_POSITION_SCHEMA)
+    hass.data[DATA_COVERS].extend(covers.values())
 
 
 class HomeMQTTCover(CoverEntity, RestoreEntity):
     """Representation of a demo cover."""
 
-    def __init__(self, hass, name, relay_up, relay_down, delay_time):
-        """Initialize the cover."""
+    def __init__(self, hass, relays, name, relay_up, relay_down, up_time,
+                 down_time):
+        """Initialize the cover.
+
+        up_time and down_time are the milliseconds of a full travel.
+        """
         self.hass = hass
+        self._relays = relays
+        self._unregister = []
+        self.groups = []
         self._name = name
         self._relay_up = relay_up
         self._relay_down = relay_down
-        self._delay_time = delay_time
+        self._travel_time = {DIRECTION_UP: up_time / 1000,
+                             DIRECTION_DOWN: down_time / 1000}
         self._is_closing = self._is_opening = False
         self._icon = ICON_OPEN
 
         self._closed = False
         self._position = 50
-        self._timer = None
+        self._motion = None
+        self._motion_end = None
+        self._motion_update = None
+        self._command_duration = None
+
+        self._target = None
+        self._next_scheduled = False
+        self._command = None
+        self._command_target = None
+        self._stopping = False
+        self._watchdog = None
 
     async def async_added_to_hass(self):
         """Call when entity about to be added to hass."""
@@ -89,47 +166,222 @@ class HomeMQTTCover(CoverEntity, RestoreEntity):
         if state:
             _LOGGER.debug("last state of %s = %s", self._name, state)
             self._position = state.attributes.get('current_position', 50)
-            
-        @callback
-        def update_status(mqttmsg):
-            if self._timer is not None:
-                elapsed_time = dt_util.utcnow() - self._timer
-                elapsed_miliseconds = int(elapsed_time.seconds * 1000 + elapsed_time.microseconds / 1000)
-                _LOGGER.debug("elapsed_miliseconds for %s = %s ", self._name, elapsed_miliseconds)
-                self._timer = None
-            else:
-                elapsed_miliseconds = 0
-            
-            if mqttmsg.topic == M_DUINO_RELAY.format(self._relay_up):
-                if mqttmsg.payload == "true":
-                    _LOGGER.debug("Opening %s", self._name)
-                    self._is_opening = True
-                    self._timer = dt_util.utcnow()
-                else:
-                    self._is_opening = False
-                    self._position+= int( (elapsed_miliseconds/self._delay_time) * 100 )
-            elif mqttmsg.topic == M_DUINO_RELAY.format(self._relay_down):
-                if mqttmsg.payload == "true":
-                    _LOGGER.debug("Closing %s", self._name)
-                    self._is_closing = True
-                    self._timer = dt_util.utcnow()
-                else:
-                    self._is_closing = False
-                    self._position-= int( (elapsed_miliseconds/self._delay_time) * 100 )
-           
-            self._closed = False
-            self._icon = ICON_OPEN
+
+        self._unregister = [
+            self._relays.async_register(
+                self._relay_up, self._relay_changed, DIRECTION_UP),
+            self._relays.async_register(
+                self._relay_down, self._relay_changed, DIRECTION_DOWN),
+        ]
+
+    async def async_will_remove_from_hass(self):
+        """Release the relays and leave the set_covers_position service."""
+        await super().async_will_remove_from_hass()
+        for unregister in self._unregister:
+            unregister()
+        self._unregister = []
+        covers = self.hass.data.get(DATA_COVERS, [])
+        if self in covers:
+            covers.remove(self)
+
+    @callback
+    def _relay_changed(self, direction, on):
+        """Handle a state change of one of the relays."""
+        if on == (self._is_opening if direction == DIRECTION_UP
+                  else self._is_closing):
+            return
+
+        now = time.monotonic()
+        self._position = self._position_at(now)
+        if on:
+            _LOGGER.debug("%s %s", "Opening" if direction == DIRECTION_UP
+                          else "Closing", self._name)
+            self._start_motion(direction, now)
+        else:
+            self._stop_motion()
+        self._is_opening = on and direction == DIRECTION_UP
+        self._is_closing = on and direction == DIRECTION_DOWN
+
+        self._closed = False
+        self._icon = ICON_OPEN
+        if not on:
             if self._position >= 99: #this accounts for timing errors
                 self._position = 100
             elif self._position <= 1:
                 self._position = 0
                 self._closed = True
                 self._icon = ICON_CLOSE
+            self._async_command_done()
+
+        self._async_update_state()
+
+    def _position_at(self, now):
+        """Return the position of the cover at monotonic time now.
+
+        The move stops at its predicted end, a relay reporting late doesn't
+        carry the cover past the commanded position.
+        """
+        if self._motion is None:
+            return self._position
+        direction, start, origin = self._motion
+        now = min(now, self._motion_end)
+        travelled = (now - start) / self._travel_time[direction] * 100
+        if direction == DIRECTION_UP:
+            return min(origin + travelled, 100)
+        return max(origin - travelled, 0)
+
+    def _start_motion(self, direction, now):
+        """Start moving from the current position.
+
+        The move ends after the duration of the command that started it,
+        or when the cover reaches its end.
+        """
+        self._stop_motion()
+        self._motion = (direction, now, self._position)
+        distance = self._position if direction == DIRECTION_DOWN \
+            else 100 - self._position
+        duration = distance / 100 * self._travel_time[direction]
+        if self._command_duration is not None:
+            duration = min(duration, self._command_duration)
+        self._motion_end = now + duration
+        self._schedule_motion_update(now)
+
+    def _stop_motion(self):
+        """Stop interpolating the position."""
+        if self._motion_update is not None:
+            self._motion_update.cancel()
+            self._motion_update = None
+        self._motion = self._motion_end = None
+
+    def _schedule_motion_update(self, now):
+        """Schedule the next position update of the move.
+
+        Updates are UPDATE_INTERVAL apart, and the last one falls on the
+        predicted end of the move.
+        """
+        self._motion_update = self.hass.loop.call_later(
+            max(min(UPDATE_INTERVAL, self._motion_end - now), 0),
+            self._async_motion_update)
+
+    @callback
+    def _async_motion_update(self):
+        """Publish the interpolated position of the moving cover."""
+        self._motion_update = None
+        now = time.monotonic()
+        self._position = self._position_at(now)
+        if now < self._motion_end:
+            self._schedule_motion_update(now)
+        self._async_update_state()
+
+    @callback
+    def _async_command_done(self):
+        """Finish the running command and start the next one."""
+        if self._command is not None and not self._stopping and \
+                self._target == self._command_target:
+            self._target = None
+        self._async_clear_command()
+        self._stopping = False
+        self._async_schedule_next()
+
+    @callback
+    def _async_clear_command(self):
+        """Forget the running command."""
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+        self._command = self._command_target = None
+        self._command_duration = None
+
+    @callback
+    def _async_cancel_command(self):
+        """Cancel a command that hasn't started its relay yet.
+
+        Returns:
+            True if the command was dropped before being published, else
+            the relay is switched off and the cover waits for it to report
+        """
+        if self._relays.async_cancel(self._command):
+            self._async_clear_command()
+            return True
+        self._stopping = True
+        self._relays.async_set(self._command, PAYLOAD_OFF)
+        return False
+
+    @callback
+    def _async_schedule_next(self):
+        """Run the latest target on the next event loop iteration.
+
+        Targets set in between, e.g. by dragging a slider, are coalesced.
+        """
+        if not self._next_scheduled:
+            self._next_scheduled = True
+            self.hass.loop.call_soon(self._async_next)
+
+    @callback
+    def _async_next(self):
+        """Move towards the target, preempting a run to another target."""
+        self._next_scheduled = False
+        if self._target is None or self._stopping:
+            return
 
-            self.async_schedule_update_ha_state(True)
+        if self._is_opening or self._is_closing:
+            if self._target != self._command_target:
+                _LOGGER.debug("Preempting %s", self._name)
+                self._stopping = True
+                self._stop_relays()
+            return
 
-        await self.hass.components.mqtt.async_subscribe(M_DUINO_RELAY.format(self._relay_up), update_status)
-        await self.hass.components.mqtt.async_subscribe(M_DUINO_RELAY.format(self._relay_down), update_status)
+        if self._command is not None:
+            if self._target == self._command_target or \
+                    not self._async_cancel_command():
+                return
+
+        diff = self._target - self._position
+        if diff >= 1:
+            _LOGGER.debug("Open")
+            self._operate_cover(
+                self._relay_up,
+                diff * self._travel_time[DIRECTION_UP] * 1000 / 100)
+        elif diff <= -1:
+            _LOGGER.debug("Close")
+            self._operate_cover(
+                self._relay_down,
+                -diff * self._travel_time[DIRECTION_DOWN] * 1000 / 100)
+        else:
+            self._target = None
+
+    @callback
+    def _async_relay_timeout(self):
+        """Give up on a relay that didn't report."""
+        self._watchdog = None
+        _LOGGER.warning("Relay %s of %s didn't report", self._command,
+                        self._name)
+        self._relays.async_cancel(self._command)
+        self._target = None
+        if self._is_opening:
+            self._relay_changed(DIRECTION_UP, False)
+        elif self._is_closing:
+            self._relay_changed(DIRECTION_DOWN, False)
+        else:
+            self._async_command_done()
+
+    def _stop_relays(self):
+        """Switch the running relays off."""
+        relays = []
+        if self._is_opening:
+            relays = [self._relay_up, self._relay_down]
+        elif self._is_closing:
+            relays = [self._relay_down, self._relay_up]
+        for r in relays:
+            self._relays.async_set(r, PAYLOAD_OFF)
+
+    @callback
+    def _async_update_state(self):
+        """Schedule a state update of the cover and of its groups."""
+        self.async_schedule_update_ha_state(True)
+        for group in self.groups:
+            if group.hass is not None:
+                group.async_schedule_update_ha_state()
 
     @property
     def name(self):
@@ -144,22 +396,15 @@ class HomeMQTTCover(CoverEntity, RestoreEntity):
     @property
     def current_cover_position(self):
         """Return current position of cover."""
-        return self._position
+        return int(round(self._position))
 
     async def async_set_cover_position(self, **kwargs):
         """Move the cover to a specific position."""
         position = kwargs.get(ATTR_POSITION)
         _LOGGER.debug("set position %s = %s", self._name, position)
 
-        diff = self._position - position
-        if diff > 0:
-            _LOGGER.debug("Close")
-            self._operate_cover(self._relay_down, diff * self._delay_time / 100)
-        elif diff < 0:
-            _LOGGER.debug("Open")
-            self._operate_cover(self._relay_up, abs(diff) * self._delay_time / 100)
-        self._position = position
-        self.async_schedule_update_ha_state(True)
+        self._target = position
+        self._async_schedule_next()
 
     @property
     def should_poll(self):
@@ -193,14 +438,24 @@ class HomeMQTTCover(CoverEntity, RestoreEntity):
 
     def _operate_cover(self, relay, time):
         time = int(time)
-        if self._is_closing or self._is_opening:
-            _LOGGER.error("Can't operate cover %s", self._name)
-            return
-
         _LOGGER.debug("_operate_cover %s @ %s for %s msec ", self._name, relay, time)
 
-        self.hass.components.mqtt.async_publish(
-            M_DUINO_RELAY_SET.format(relay), time, qos=0, retain=False)
+        self._command = relay
+        self._command_target = self._target
+        self._command_duration = time / 1000
+        self._relays.async_set(relay, time, self._async_command_published)
+
+    @callback
+    def _async_command_published(self):
+        """Watch the relay from the time its start is published.
+
+        A start can wait in the staggered batch for long, e.g. 30s behind
+        150 other covers at the default stagger.
+        """
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+        self._watchdog = self.hass.loop.call_later(
+            self._command_duration + RELAY_TIMEOUT, self._async_relay_timeout)
 
     async def async_close_cover(self, **kwargs):
         """Close the cover."""
@@ -214,17 +469,99 @@ class HomeMQTTCover(CoverEntity, RestoreEntity):
         
     async def async_stop_cover(self, **kwargs):
         """Stop the cover."""
-        relays = []
-        if self._is_opening:
-            relays = [self._relay_up, self._relay_down]
-        elif self._is_closing:
-            relays = [self._relay_down, self._relay_up]
+        self._target = None
+        if self._is_opening or self._is_closing:
+            self._stopping = True
+            self._stop_relays()
+        elif self._command is not None:
+            self._async_cancel_command()
         else:
             self._position = 50
             self._closed = False
-            self._timer = None
-            self.async_schedule_update_ha_state(True)
-        
-        for r in relays:
-            self.hass.components.mqtt.async_publish(
-                M_DUINO_RELAY_SET.format(r), "false", qos=0, retain=False)
+            self._async_update_state()
+
+
+class HomeMQTTCoverGroup(CoverEntity):
+    """Covers operated together.
+
+    The commands of every cover are issued in the same event loop
+    iteration, so they are published as one staggered batch.
+    """
+
+    def __init__(self, name, covers):
+        """Initialize the group."""
+        self._name = name
+        self._covers = covers
+        for cover in covers:
+            cover.groups.append(self)
+
+    @property
+    def name(self):
+        """Return the name of the group."""
+        return self._name
+
+    @property
+    def should_poll(self):
+        """Updated by the covers."""
+        return False
+
+    @property
+    def icon(self):
+        """Return the icon to use in the frontend, if any."""
+        return ICON_CLOSE if self.is_closed else ICON_OPEN
+
+    @property
+    def device_class(self):
+        """Return the class of this device, from component DEVICE_CLASSES."""
+        return "window"
+
+    @property
+    def unique_id(self):
+        """Return a unique, HASS-friendly identifier for this entity."""
+        return "m-duino-group-{}".format(self._name)
+
+    @property
+    def current_cover_position(self):
+        """Return the mean position of the covers."""
+        return int(round(statistics.mean(
+            cover.current_cover_position for cover in self._covers)))
+
+    @property
+    def is_closed(self):
+        """Return True if every cover is closed."""
+        return all(cover.is_closed for cover in self._covers)
+
+    @property
+    def is_closing(self):
+        """Return True if any cover is closing."""
+        return any(cover.is_closing for cover in self._covers)
+
+    @property
+    def is_opening(self):
+        """Return True if any cover is opening."""
+        return any(cover.is_opening for cover in self._covers)
+
+    @property
+    def device_state_attributes(self):
+        """Return the covers of the group."""
+        return {ATTR_ENTITY_ID: [cover.entity_id for cover in self._covers]}
+
+    async def async_set_cover_position(self, **kwargs):
+        """Move every cover to a specific position."""
+        for cover in self._covers:
+            await cover.async_set_cover_position(**kwargs)
+
+    async def async_close_cover(self, **kwargs):
+        """Close every cover."""
+        for cover in self._covers:
+            await cover.async_close_cover(**kwargs)
+
+    async def async_open_cover(self, **kwargs):
+        """Open every cover."""
+        for cover in self._covers:
+            await cover.async_open_cover(**kwargs)
+
+    async def async_stop_cover(self, **kwargs):
+        """Stop every cover."""
+        for cover in self._covers:
+            await cover.async_stop_cover(**kwargs)
@@ -0,0 +1,266 @@
+"""
+Load benchmark of the homegw covers.
+
+Drives hundreds of HomeMQTTCover, in-process, against the simulated relays
+of m_duino_simulator.py through storms of open, close, slider drag and
+preempting commands, then reports for every storm:
+
+- latency: from a command to the cover reporting it moves towards the
+  commanded position
+- position error: between the position every cover reports once settled
+  and the position its simulated motor actually reached
+- timeouts: relays the covers gave up waiting for
+
+    python homegw/cover_benchmark.py --covers 200 --jitter 20 --travel-error 0.02
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import types
+from collections import namedtuple
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from homegw.cover import HomeMQTTCover, DIRECTION_UP, DIRECTION_DOWN
+from homegw.m_duino import MDuinoRelays, M_DUINO_RELAY, DEFAULT_STAGGER
+from homegw.m_duino_simulator import RelayBoard
+
+Message = namedtuple('Message', 'topic payload')
+
+SETTLE_TIMEOUT = 300  # seconds
+
+
+class BenchRelays(MDuinoRelays):
+    """Relays wired to a simulated board instead of MQTT."""
+
+    board = None
+
+    async def async_subscribe(self):
+        """Nothing to subscribe to."""
+
+    def _publish(self, relay, payload):
+        """Send the command to the board."""
+        self.board.set(relay, payload)
+
+    def report(self, relay, payload):
+        """Receive a relay report of the board."""
+        self._message_received(Message(M_DUINO_RELAY.format(relay), payload))
+
+
+class BenchCover(HomeMQTTCover):
+    """Cover recording its state updates and command latencies."""
+
+    def __init__(self, *args, **kwargs):
+        """Initialize the cover."""
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+        self.updates = 0
+        self.timeouts = 0
+        self._commanded = None
+
+    async def async_set_cover_position(self, **kwargs):
+        """Time the command, unless the cover is already there."""
+        target = kwargs['position']
+        if abs(target - self._position) >= 1 or self.is_opening or \
+                self.is_closing:
+            self._commanded = (target, self.hass.loop.time())
+        await super().async_set_cover_position(**kwargs)
+
+    def async_schedule_update_ha_state(self, force_refresh=False):
+        """Record the state update."""
+        self.updates += 1
+        if self._commanded is not None and \
+                (self.is_opening or self.is_closing) and \
+                self._command_target == self._commanded[0]:
+            self.latencies.append(
+                self.hass.loop.time() - self._commanded[1])
+            self._commanded = None
+
+    def _async_relay_timeout(self):
+        """Count the relay timeout."""
+        self.timeouts += 1
+        super()._async_relay_timeout()
+
+    @property
+    def settled(self):
+        """Return True once the cover has nothing left to do."""
+        return not (self.is_opening or self.is_closing) and \
+            self._command is None and self._target is None
+
+
+class Motors(object):
+    """Positions actually reached by the simulated motors."""
+
+    def __init__(self, covers, travel_error):
+        """Give every motor a travel time off by up to travel_error."""
+        self.relays = {}
+        self.position = {}
+        self.travel = {}
+        self.started = {}
+        for cover in covers:
+            self.position[cover] = cover._position
+            for relay, direction in ((cover._relay_up, DIRECTION_UP),
+                                     (cover._relay_down, DIRECTION_DOWN)):
+                self.relays[relay] = (cover, direction)
+                self.travel[relay] = cover._travel_time[direction] * \
+                    (1 + random.uniform(-travel_error, travel_error))
+
+    def changed(self, relay, on, now):
+        """Integrate the motion of relay."""
+        if on:
+            self.started[relay] = now
+            return
+        start = self.started.pop(relay, None)
+        if start is None:
+            return
+        cover, direction = self.relays[relay]
+        travelled = (now - start) / self.travel[relay] * 100
+        if direction == DIRECTION_DOWN:
+            travelled = -travelled
+        self.position[cover] = min(max(
+            self.position[cover] + travelled, 0), 100)
+
+
+async def settle(covers, board):
+    """Wait until every cover is idle."""
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + SETTLE_TIMEOUT
+    while loop.time() < deadline:
+        if all(cover.settled for cover in covers) and \
+                not any(board.is_on(relay) for cover in covers
+                        for relay in (cover._relay_up, cover._relay_down)):
+            return
+        await asyncio.sleep(0.1)
+    print("  not settled after {}s".format(SETTLE_TIMEOUT))
+
+
+async def storm_open(covers):
+    """Open every cover at once."""
+    for cover in covers:
+        await cover.async_open_cover()
+
+
+async def storm_close(covers):
+    """Close every cover at once."""
+    for cover in covers:
+        await cover.async_close_cover()
+
+
+async def storm_drag(covers):
+    """Drag the slider of half of the covers."""
+    async def drag(cover):
+        await asyncio.sleep(random.uniform(0, 1))
+        for _ in range(random.randint(3, 6)):
+            await cover.async_set_cover_position(
+                position=random.randint(0, 100))
+            await asyncio.sleep(random.uniform(0.05, 0.15))
+
+    await asyncio.gather(*[drag(cover) for cover in covers
+                           if random.random() < 0.5])
+
+
+async def storm_preempt(covers):
+    """Redirect every cover halfway through a move."""
+    async def redirect(cover):
+        await cover.async_set_cover_position(
+            position=100 if cover.current_cover_position < 50 else 0)
+        await asyncio.sleep(
+            random.uniform(0.2, 0.6) * cover._travel_time[DIRECTION_UP])
+        await cover.async_set_cover_position(position=random.randint(0, 100))
+
+    await asyncio.gather(*[redirect(cover) for cover in covers])
+
+
+STORMS = (
+    ('open', storm_open),
+    ('close', storm_close),
+    ('drag', storm_drag),
+    ('preempt', storm_preempt),
+)
+
+
+async def run(args):
+    """Run every storm and print its statistics."""
+    loop = asyncio.get_event_loop()
+    hass = types.SimpleNamespace(loop=loop, data={})
+    relays = BenchRelays(hass)
+    relays.stagger = args.stagger / 1000
+
+    covers = []
+    for index in range(args.covers):
+        up_time = random.uniform(1, 2) * args.travel * 1000
+        cover = BenchCover(hass, relays, "cover_{}".format(index),
+                           2 * index + 1, 2 * index + 2,
+                           up_time, 0.9 * up_time)
+        relays.async_register(cover._relay_up, cover._relay_changed,
+                              DIRECTION_UP)
+        relays.async_register(cover._relay_down, cover._relay_changed,
+                              DIRECTION_DOWN)
+        covers.append(cover)
+
+    motors = Motors(covers, args.travel_error)
+    relays.board = board = RelayBoard(loop, relays.report, args.jitter / 1000,
+                                      args.drop, motors.changed)
+
+    print("{} covers, stagger {} ms, jitter {} ms, drop {:.1%}, "
+          "travel error {:.1%}".format(args.covers, args.stagger, args.jitter,
+                                       args.drop, args.travel_error))
+    print("{:<8} {:>8} {:>9} {:>9} {:>9} {:>10} {:>10} {:>8} {:>8}".format(
+        'storm', 'commands', 'p50 ms', 'p95 ms', 'max ms', 'err mean',
+        'err max', 'updates', 'timeouts'))
+    for name, storm in STORMS:
+        for cover in covers:
+            cover.latencies = []
+            cover.updates = 0
+            cover.timeouts = 0
+        commands = board.commands
+        start = loop.time()
+        await storm(covers)
+        await settle(covers, board)
+        elapsed = loop.time() - start
+
+        latencies = sorted(latency * 1000 for cover in covers
+                           for latency in cover.latencies)
+        errors = [abs(cover.current_cover_position - motors.position[cover])
+                  for cover in covers]
+        updates = sum(cover.updates for cover in covers)
+        timeouts = sum(cover.timeouts for cover in covers)
+        if not latencies:
+            latencies = [float('nan')]
+        print("{:<8} {:>8} {:>9.1f} {:>9.1f} {:>9.1f} {:>10.2f} {:>10.2f} "
+              "{:>8} {:>8}".format(
+                  name, board.commands - commands,
+                  latencies[len(latencies) // 2],
+                  latencies[int(len(latencies) * 0.95)], latencies[-1],
+                  statistics.mean(errors), max(errors), updates, timeouts))
+        print("{:<8} settled in {:.1f}s, {:.2f} updates/s per cover".format(
+            '', elapsed, updates / elapsed / len(covers)))
+    if board.dropped:
+        print("{} messages dropped".format(board.dropped))
+
+
+def main():
+    """Parse the options and run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--covers', type=int, default=200)
+    parser.add_argument('--travel', type=float, default=3,
+                        help="shortest full travel, in seconds")
+    parser.add_argument('--stagger', type=int, default=DEFAULT_STAGGER,
+                        help="milliseconds between relay starts")
+    parser.add_argument('--jitter', type=int, default=20,
+                        help="maximum delay of messages, in milliseconds")
+    parser.add_argument('--drop', type=float, default=0,
+                        help="probability of losing a message")
+    parser.add_argument('--travel-error', type=float, default=0,
+                        help="relative error of the configured travel times")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    asyncio.new_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
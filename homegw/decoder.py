@@ -0,0 +1,102 @@
+"""
+Decoder of HomeGW packets.
+
+Turns the raw JSON of a packet into a slotted Reading. orjson is used when
+available, and decoded packets are cached by their raw string so the
+repeated frames of a burst are only decoded once.
+"""
+from functools import lru_cache
+
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
+ATTR_HOMEGW_DEV = 'dev'
+ATTR_HOMEGW_TEMPERATURE = 'temp'
+ATTR_HOMEGW_HUMIDITY = 'hum'
+ATTR_HOMEGW_PRESSURE = 'pressure'
+ATTR_HOMEGW_ID = 'id'
+ATTR_HOMEGW_CHANNEL = 'ch'
+ATTR_HOMEGW_BATTERY = 'batt'
+
+VALUE_HOMEGW_DEV_WEATHER = 'weather'
+VALUE_HOMEGW_DEV_DIGOO = 'digoo'
+
+CACHE_SIZE = 256
+
+
+class Reading(object):
+    """A decoded packet, fields missing from the packet are None.
+
+    Readings are shared through the decode cache and must not be modified.
+    """
+
+    __slots__ = ('dev', 'id', 'channel', 'temperature', 'humidity',
+                 'pressure', 'battery')
+
+    def __init__(self, dev, device_id=None, channel=None, temperature=None,
+                 humidity=None, pressure=None, battery=None):
+        """Keep the decoded fields."""
+        self.dev = dev
+        self.id = device_id
+        self.channel = channel
+        self.temperature = temperature
+        self.humidity = humidity
+        self.pressure = pressure
+        self.battery = battery
+
+    def _fields(self):
+        """Return the fields as a tuple."""
+        return (self.dev, self.id, self.channel, self.temperature,
+                self.humidity, self.pressure, self.battery)
+
+    def __eq__(self, other):
+        """Return True if both readings have the same fields."""
+        return isinstance(other, Reading) and \
+            self._fields() == other._fields()
+
+    def __hash__(self):
+        """Hash the fields."""
+        return hash(self._fields())
+
+    def __repr__(self):
+        """Return the representation of the reading."""
+        return "Reading({})".format(", ".join(
+            "{}={}".format(name, getattr(self, name))
+            for name in self.__slots__ if getattr(self, name) is not None))
+
+
+def _optional(payload, key, kind):
+    """Return payload[key] converted to kind, None if missing."""
+    value = payload.get(key)
+    if value is None:
+        return None
+    return kind(value)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def decode(raw):
+    """Decode a raw packet.
+
+    Returns:
+        Reading, or None if raw is not a HomeGW packet
+    """
+    try:
+        payload = _loads(raw)
+        dev = payload[ATTR_HOMEGW_DEV]
+        reading = Reading(
+            dev,
+            _optional(payload, ATTR_HOMEGW_ID, int),
+            _optional(payload, ATTR_HOMEGW_CHANNEL, int))
+        if dev in (VALUE_HOMEGW_DEV_WEATHER, VALUE_HOMEGW_DEV_DIGOO):
+            reading.temperature = float(payload[ATTR_HOMEGW_TEMPERATURE])
+            reading.humidity = int(payload[ATTR_HOMEGW_HUMIDITY])
+            reading.battery = bool(payload[ATTR_HOMEGW_BATTERY])
+        if dev == VALUE_HOMEGW_DEV_WEATHER:
+            pressure = _optional(payload, ATTR_HOMEGW_PRESSURE, int)
+            if pressure is not None:
+                reading.pressure = pressure / 100  # unit hPa
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return None
+    return reading
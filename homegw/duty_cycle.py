@@ -0,0 +1,139 @@
+"""
+Heating duty cycle over sliding windows.
+
+Every completed on period is appended once to a shared log of (start, end)
+intervals. Each window keeps the total on time of the intervals that ended
+inside it and the index of the oldest of them, so updating a window only
+retires the intervals that slid out since the last update. Intervals are
+dropped from the log once they left the longest window.
+
+The log isn't persisted: snapshot() sums it up per window, and restore()
+seeds a new log with intervals spreading those sums evenly over each window,
+so the windows resume from their values at the snapshot.
+"""
+import math
+from collections import deque
+
+RESTORE_CHUNK = 300  # seconds, resolution of a restored log
+
+
+class DutyCycle(object):
+    """On time of a binary state over several sliding windows."""
+
+    def __init__(self, windows, timestamp):
+        """Initialize the log, off since timestamp.
+
+        Args:
+            windows (iterable): window lengths, in seconds
+            timestamp (float): start of the observation
+        """
+        self._windows = tuple(windows)
+        self._log = deque()
+        self._offset = 0  # index of _log[0] since the start
+        self._first = {window: 0 for window in self._windows}
+        self._on_time = {window: 0.0 for window in self._windows}
+        self._on_since = None
+        self._started = timestamp
+
+    @property
+    def is_on(self):
+        """Return True while the state is on."""
+        return self._on_since is not None
+
+    def set_state(self, on, timestamp):
+        """Record the state at timestamp, repeated states are ignored."""
+        if on and self._on_since is None:
+            self._on_since = timestamp
+        elif not on and self._on_since is not None:
+            self._log.append((self._on_since, timestamp))
+            for window in self._windows:
+                self._on_time[window] += timestamp - self._on_since
+            self._on_since = None
+
+    def snapshot(self, timestamp):
+        """Return the on time of every window and the time observed.
+
+        Returns:
+            ({window: seconds on}, seconds observed), up to timestamp
+        """
+        return ({window: self.on_time(window, timestamp)
+                 for window in self._windows},
+                timestamp - self._started)
+
+    def restore(self, on_times, observed, timestamp):
+        """Seed the log with a snapshot taken at timestamp.
+
+        Must be called before any set_state(). The time between timestamp
+        and the start of this log counts as off.
+
+        Args:
+            on_times (dict): seconds on during each window, from snapshot()
+            observed (float): seconds observed, from snapshot()
+            timestamp (float): time of the snapshot, on the clock of this log
+        """
+        intervals = []
+        newer, newer_on = 0, 0.0
+        for window in sorted(self._windows):
+            on_time = on_times.get(window)
+            if on_time is None:
+                break
+            # on time between window and newer seconds before timestamp
+            span_start = timestamp - min(window, observed)
+            span_end = timestamp - newer
+            length = span_end - span_start
+            on_time = min(max(on_time - newer_on, 0.0), max(length, 0.0))
+            if length > 0 and on_time > 0:
+                chunks = int(math.ceil(length / RESTORE_CHUNK))
+                size = length / chunks
+                for chunk in range(chunks):
+                    middle = span_start + (chunk + 0.5) * size
+                    half = on_time / chunks / 2
+                    intervals.append((middle - half, middle + half))
+            newer, newer_on = window, newer_on + on_time
+
+        intervals.sort()
+        self._log.extend(intervals)
+        total = sum(end - start for start, end in intervals)
+        for window in self._windows:
+            self._on_time[window] += total
+        self._started = min(self._started, timestamp - observed)
+
+    def _expire(self, window, deadline):
+        """Retire the intervals of window that ended before deadline."""
+        log = self._log
+        index = self._first[window]
+        while index - self._offset < len(log) and \
+                log[index - self._offset][1] <= deadline:
+            start, end = log[index - self._offset]
+            self._on_time[window] -= end - start
+            index += 1
+        self._first[window] = index
+
+        oldest = min(self._first.values())
+        while self._offset < oldest:
+            log.popleft()
+            self._offset += 1
+
+    def on_time(self, window, timestamp):
+        """Return the seconds spent on during window up to timestamp."""
+        deadline = timestamp - window
+        self._expire(window, deadline)
+        on_time = self._on_time[window]
+
+        index = self._first[window] - self._offset
+        if index < len(self._log) and self._log[index][0] < deadline:
+            on_time -= deadline - self._log[index][0]
+        if self._on_since is not None:
+            on_time += timestamp - max(self._on_since, deadline)
+        return max(on_time, 0.0)
+
+    def duty_cycle(self, window, timestamp):
+        """Return the fraction of window spent on, None before any time.
+
+        Until a full window has been observed, the fraction is of the time
+        observed so far.
+        """
+        observed = min(window, timestamp - self._started)
+        if observed <= 0:
+            return None
+        return self.on_time(window, timestamp) / observed
@@ -0,0 +1,212 @@
+"""
+Local weather forecast of the HomeGW weather station.
+
+PressureTrend keeps the least squares slope of the pressure over a sliding
+window, updated in O(1) per sample from running sums. zambretti() turns the
+sea level pressure and its 3 hour trend into one of the 26 Zambretti
+forecasts. SunSchedule caches the next sunrise and sunset so checking
+whether the sun is up doesn't recompute the sun position every time.
+"""
+import math
+from collections import deque
+
+from homeassistant.const import SUN_EVENT_SUNRISE, SUN_EVENT_SUNSET
+from homeassistant.helpers.sun import get_astral_event_next
+import homeassistant.util.dt as dt_util
+
+STEADY_THRESHOLD = 1.6  # hPa per 3 hours
+
+TREND_FALLING = 'falling'
+TREND_STEADY = 'steady'
+TREND_RISING = 'rising'
+
+# Forecast letters, from the best to the worst weather, of each trend
+ZAMBRETTI_FALLING = 'ABDHORUVX'
+ZAMBRETTI_STEADY = 'ABEKNPSWXZ'
+ZAMBRETTI_RISING = 'ABCFGIJLMQTYZ'
+
+ZAMBRETTI_FORECASTS = {
+    'A': "Settled fine",
+    'B': "Fine weather",
+    'C': "Becoming fine",
+    'D': "Fine, becoming less settled",
+    'E': "Fine, possible showers",
+    'F': "Fairly fine, improving",
+    'G': "Fairly fine, possible showers early",
+    'H': "Fairly fine, showery later",
+    'I': "Showery early, improving",
+    'J': "Changeable, mending",
+    'K': "Fairly fine, showers likely",
+    'L': "Rather unsettled, clearing later",
+    'M': "Unsettled, probably improving",
+    'N': "Showery, bright intervals",
+    'O': "Showery, becoming less settled",
+    'P': "Changeable, some rain",
+    'Q': "Unsettled, short fine intervals",
+    'R': "Unsettled, rain later",
+    'S': "Unsettled, some rain",
+    'T': "Mostly very unsettled",
+    'U': "Occasional rain, worsening",
+    'V': "Rain at times, very unsettled",
+    'W': "Rain at frequent intervals",
+    'X': "Rain, very unsettled",
+    'Y': "Stormy, may improve",
+    'Z': "Stormy, much rain",
+}
+
+# Weather entity condition of each forecast letter
+ZAMBRETTI_CONDITIONS = {}
+for _letters, _condition in (('ABC', 'sunny'),
+                             ('DF', 'partlycloudy'),
+                             ('EGHJKLM', 'cloudy'),
+                             ('INOPQRSUW', 'rainy'),
+                             ('TVX', 'pouring'),
+                             ('YZ', 'lightning-rainy')):
+    for _letter in _letters:
+        ZAMBRETTI_CONDITIONS[_letter] = _condition
+
+
+class PressureTrend(object):
+    """Least squares slope of the pressure over the last window seconds.
+
+    Timestamps and pressures are summed relative to an origin sample, which
+    keeps the running sums small; the sums are rebuilt from the window when
+    the origin gets older than two windows.
+    """
+
+    def __init__(self, window):
+        """Initialize an empty trend over window seconds."""
+        self.window = window
+        self._samples = deque()
+        self._origin = None
+        self._sums = [0.0] * 5  # n, t, p, tt, tp
+
+    def _add(self, timestamp, pressure, sign):
+        """Add (sign=1) or remove (sign=-1) a sample from the sums."""
+        t = timestamp - self._origin[0]
+        p = pressure - self._origin[1]
+        sums = self._sums
+        sums[0] += sign
+        sums[1] += sign * t
+        sums[2] += sign * p
+        sums[3] += sign * t * t
+        sums[4] += sign * t * p
+
+    def _rebase(self):
+        """Rebuild the sums relative to the oldest sample."""
+        self._origin = self._samples[0]
+        self._sums = [0.0] * 5
+        for timestamp, pressure in self._samples:
+            self._add(timestamp, pressure, 1)
+
+    def append(self, timestamp, pressure):
+        """Add a sample, timestamps must not decrease."""
+        if self._origin is None:
+            self._origin = (timestamp, pressure)
+        self._samples.append((timestamp, pressure))
+        self._add(timestamp, pressure, 1)
+
+        deadline = timestamp - self.window
+        while self._samples[0][0] < deadline:
+            self._add(*self._samples.popleft(), -1)
+
+        if self._samples[0][0] - self._origin[0] > 2 * self.window:
+            self._rebase()
+
+    @property
+    def slope(self):
+        """Return the slope in hPa per hour, None without enough history.
+
+        The samples must cover at least a third of the window.
+        """
+        if len(self._samples) < 2 or \
+                self._samples[-1][0] - self._samples[0][0] < self.window / 3:
+            return None
+        n, t, p, tt, tp = self._sums
+        denominator = n * tt - t * t
+        if denominator <= 0:
+            return None
+        return (n * tp - t * p) / denominator * 3600
+
+
+def sea_level_pressure(pressure, elevation, temperature):
+    """Reduce the station pressure (hPa) to sea level.
+
+    Args:
+        pressure (float): station pressure in hPa
+        elevation (float): station elevation in meters
+        temperature (float): outside temperature in Celsius
+    """
+    if not elevation:
+        return pressure
+    lapse = 0.0065 * elevation
+    return pressure * math.pow(
+        1 - lapse / (temperature + lapse + 273.15), -5.257)
+
+
+def pressure_trend(change):
+    """Return the trend of a pressure change (hPa over 3 hours)."""
+    if change <= -STEADY_THRESHOLD:
+        return TREND_FALLING
+    if change >= STEADY_THRESHOLD:
+        return TREND_RISING
+    return TREND_STEADY
+
+
+def zambretti(pressure, change, month, northern=True):
+    """Return the Zambretti forecast letter.
+
+    Args:
+        pressure (float): sea level pressure in hPa
+        change (float): pressure change over the last 3 hours, in hPa
+        month (int): 1 to 12
+        northern (bool): False in the southern hemisphere
+
+    In summer a rising pressure forecasts one step better weather, and in
+    winter a falling pressure one step worse.
+    """
+    trend = pressure_trend(change)
+    summer = (4 <= month <= 9) == northern
+    if trend == TREND_FALLING:
+        letters = ZAMBRETTI_FALLING
+        index = 127 - 0.12 * pressure
+        index += 0 if summer else 1
+    elif trend == TREND_RISING:
+        letters = ZAMBRETTI_RISING
+        index = 185 - 0.16 * pressure
+        index -= 1 if summer else 0
+        index -= 19
+    else:
+        letters = ZAMBRETTI_STEADY
+        index = 144 - 0.13 * pressure
+        index -= 9
+    index = int(round(index)) - 1
+    return letters[min(max(index, 0), len(letters) - 1)]
+
+
+class SunSchedule(object):
+    """Whether the sun is up, from a cached sunrise/sunset schedule."""
+
+    def __init__(self, hass):
+        """Initialize an empty schedule."""
+        self._hass = hass
+        self._next_change = None
+        self._up = None
+
+    def is_up(self, utc_point_in_time=None):
+        """Return True if the sun is up.
+
+        The next sunrise and sunset are only computed once the cached one
+        has passed.
+        """
+        if utc_point_in_time is None:
+            utc_point_in_time = dt_util.utcnow()
+        if self._next_change is None or \
+                utc_point_in_time >= self._next_change:
+            next_rising = get_astral_event_next(
+                self._hass, SUN_EVENT_SUNRISE, utc_point_in_time)
+            next_setting = get_astral_event_next(
+                self._hass, SUN_EVENT_SUNSET, utc_point_in_time)
+            self._up = next_setting < next_rising
+            self._next_change = min(next_rising, next_setting)
+        return self._up
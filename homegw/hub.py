@@ -0,0 +1,216 @@
+"""
+HomeGW hub, shared by the homegw platforms.
+
+Subscribes once to the packets of a gateway, either through the state of a
+serial sensor entity or directly to the MQTT topic the gateway publishes to,
+decodes each payload once and routes it to the entities registered for its
+(dev, ch, id).
+
+433 MHz sensors send every reading in a burst of repeated frames, so
+identical frames of a device within the de-duplication window are dropped.
+
+The hub also indexes every (dev, id, ch) it receives, announces the ones no
+entity is registered for to the discovery listeners, and forgets devices
+that stay idle longer than the idle timeout.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from homeassistant.const import STATE_UNKNOWN, STATE_UNAVAILABLE
+from homeassistant.core import callback
+from homeassistant.helpers.event import (
+    async_track_state_change, async_track_time_interval)
+
+from .decoder import decode
+
+_LOGGER = logging.getLogger(__name__)
+
+DATA_HOMEGW = 'homegw'
+
+DEFAULT_DEDUP_WINDOW = 2000  # milliseconds
+DEFAULT_IDLE_TIMEOUT = 3600  # seconds
+
+EVICT_INTERVAL = timedelta(minutes=1)
+
+
+async def async_get_hub(hass, serial_sensor=None, mqtt_topic=None,
+                        dedup_window=DEFAULT_DEDUP_WINDOW,
+                        idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    """Return the hub of a gateway, creating it on first use.
+
+    Args:
+        serial_sensor (string): entity whose state is the last packet
+        mqtt_topic (string): topic the gateway publishes packets to, used
+            instead of serial_sensor
+        dedup_window (int): milliseconds during which identical frames of
+            a device are dropped, the hub uses the largest one requested
+        idle_timeout (int): seconds without packets after which a device
+            is forgotten, the hub uses the largest one requested
+    """
+    hubs = hass.data.setdefault(DATA_HOMEGW, {})
+    key = (serial_sensor, mqtt_topic)
+    if key not in hubs:
+        hubs[key] = HomeGWHub(hass)
+        if mqtt_topic is not None:
+            await hubs[key].async_subscribe_mqtt(mqtt_topic)
+        else:
+            hubs[key].async_track_serial_sensor(serial_sensor)
+    hub = hubs[key]
+    hub.dedup_window = max(hub.dedup_window, dedup_window / 1000)
+    hub.idle_timeout = max(hub.idle_timeout, idle_timeout)
+    return hub
+
+
+class HomeGWHub(object):
+    """Decode the packets of a HomeGW gateway and route them."""
+
+    def __init__(self, hass):
+        """Initialize the hub."""
+        self._hass = hass
+        self._routes = {}
+        self._last_frames = {}
+        self._last_seen = {}
+        self._discovered = set()
+        self._discovery_listeners = {}
+        self.dedup_window = 0
+        self.idle_timeout = 0
+        async_track_time_interval(hass, self._async_evict, EVICT_INTERVAL)
+
+    @callback
+    def async_track_serial_sensor(self, serial_sensor):
+        """Receive packets through the state of serial_sensor."""
+        async_track_state_change(self._hass, serial_sensor,
+                                 self._sensor_changed)
+
+    async def async_subscribe_mqtt(self, topic):
+        """Receive packets straight from the gateway MQTT topic."""
+        await self._hass.components.mqtt.async_subscribe(
+            topic, self._message_received)
+
+    @callback
+    def async_register(self, handler, dev, channel=None, device_id=None):
+        """Call handler(payload) for the packets of a device.
+
+        Args:
+            handler (callable): called with the decoded Reading
+            dev (string): device type, e.g. 'digoo'
+            channel (int): channel, None matches every channel
+            device_id (int): device id, None matches every id
+
+        Returns:
+            callable that removes the registration
+        """
+        key = (dev, channel, device_id)
+        self._routes.setdefault(key, []).append(handler)
+
+        @callback
+        def async_unregister():
+            """Remove the registration."""
+            handlers = self._routes.get(key, [])
+            if handler in handlers:
+                handlers.remove(handler)
+            if not handlers:
+                self._routes.pop(key, None)
+
+        return async_unregister
+
+    @callback
+    def async_listen_discovery(self, dev, new_device, device_idle=None):
+        """Announce the devices of type dev no entity is registered for.
+
+        Args:
+            dev (string): device type, e.g. 'digoo'
+            new_device (callable): called with the first Reading of each
+                unknown (dev, id, ch)
+            device_idle (callable): called with (dev, id, ch) when an
+                announced device has been idle for idle_timeout
+        """
+        self._discovery_listeners.setdefault(dev, []).append(
+            (new_device, device_idle))
+
+    @property
+    def devices(self):
+        """Return the (dev, id, ch) of every device heard recently."""
+        return list(self._last_seen)
+
+    @callback
+    def _async_evict(self, now=None):
+        """Forget the devices that have been idle for idle_timeout."""
+        deadline = time.monotonic() - self.idle_timeout
+        for device in [device for device, last_seen
+                       in self._last_seen.items() if last_seen < deadline]:
+            del self._last_seen[device]
+            self._last_frames.pop(device, None)
+            if device not in self._discovered:
+                continue
+            self._discovered.discard(device)
+            _LOGGER.debug("Device %s is idle", device)
+            for _, device_idle in self._discovery_listeners.get(device[0], ()):
+                if device_idle is not None:
+                    device_idle(device)
+
+    @callback
+    def _sensor_changed(self, entity_id, old_state, new_state):
+        """Handle serial sensor state changes."""
+        if new_state is None:
+            return
+        elif new_state.state in [STATE_UNKNOWN, STATE_UNAVAILABLE]:
+            return
+
+        self._decode(new_state.state)
+
+    @callback
+    def _message_received(self, msg):
+        """Handle a packet published by the gateway."""
+        self._decode(msg.payload)
+
+    @callback
+    def _decode(self, raw):
+        """Decode a raw packet and dispatch it."""
+        reading = decode(raw)
+        if reading is None:
+            _LOGGER.warning("Could not process: %s", raw)
+            return
+
+        self.async_dispatch(reading)
+
+    @callback
+    def async_dispatch(self, reading):
+        """Route a decoded Reading to the handlers of its device."""
+        dev = reading.dev
+        channel = reading.channel
+        device_id = reading.id
+
+        device = (dev, device_id, channel)
+        if self._is_repeat(device, reading):
+            return
+
+        routed = False
+        for key in {(dev, channel, device_id),
+                    (dev, channel, None),
+                    (dev, None, None)}:
+            for handler in tuple(self._routes.get(key, ())):
+                handler(reading)
+                routed = True
+
+        if not routed and device not in self._discovered and \
+                dev in self._discovery_listeners:
+            _LOGGER.debug("Discovered device %s", device)
+            self._discovered.add(device)
+            for new_device, _ in tuple(self._discovery_listeners[dev]):
+                new_device(reading)
+
+    def _is_repeat(self, device, reading):
+        """Return True if reading repeats a recent frame of device.
+
+        The window starts at the first frame of a burst, so a device that
+        keeps reporting the same values is still dispatched once per window.
+        """
+        now = self._last_seen[device] = time.monotonic()
+        last = self._last_frames.get(device)
+        if last is not None and last[0] == reading and \
+                now - last[1] < self.dedup_window:
+            return True
+        self._last_frames[device] = (reading, now)
+        return False
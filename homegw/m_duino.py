@@ -0,0 +1,148 @@
+"""
+Relays of an m-duino board, shared by the homegw covers.
+
+The board publishes the state of relay N on devices/m-duino/relay/N. A single
+wildcard subscription receives every relay and routes it, by relay number,
+to the cover and direction owning it.
+
+Relay commands issued during the same event loop iteration, e.g. by a group
+of covers, are published as one batch. Starting motors can be staggered to
+limit inrush current on the relay board; stop commands are never delayed.
+"""
+import logging
+from collections import OrderedDict
+
+from homeassistant.core import callback
+
+_LOGGER = logging.getLogger(__name__)
+
+DATA_M_DUINO = 'm_duino'
+
+M_DUINO_RELAY = "devices/m-duino/relay/{}"
+M_DUINO_RELAY_SET = M_DUINO_RELAY + "/set"
+M_DUINO_RELAYS = M_DUINO_RELAY.format('+')
+
+PAYLOAD_ON = "true"
+PAYLOAD_OFF = "false"
+
+DEFAULT_STAGGER = 200  # milliseconds
+
+
+async def async_get_relays(hass, stagger=DEFAULT_STAGGER):
+    """Return the relays of the board, subscribing on first use.
+
+    Args:
+        stagger (int): milliseconds between the start of two relays, the
+            board uses the largest one requested
+    """
+    if DATA_M_DUINO not in hass.data:
+        relays = hass.data[DATA_M_DUINO] = MDuinoRelays(hass)
+        await relays.async_subscribe()
+    relays = hass.data[DATA_M_DUINO]
+    relays.stagger = max(relays.stagger, stagger / 1000)
+    return relays
+
+
+class MDuinoRelays(object):
+    """Route relay state changes of an m-duino board."""
+
+    def __init__(self, hass):
+        """Initialize the relays."""
+        self._hass = hass
+        self._routes = {}
+        self._prefix = M_DUINO_RELAY.format('')
+        self._starts = OrderedDict()
+        self._flush = None
+        self._last_start = None
+        self.stagger = 0
+
+    async def async_subscribe(self):
+        """Subscribe to the state of every relay."""
+        await self._hass.components.mqtt.async_subscribe(
+            M_DUINO_RELAYS, self._message_received)
+
+    @callback
+    def async_register(self, relay, handler, direction):
+        """Call handler(direction, on) when relay changes state.
+
+        Returns:
+            callable that removes the registration
+        """
+        if relay in self._routes:
+            _LOGGER.error("Relay %s is already in use", relay)
+        self._routes[relay] = (handler, direction)
+
+        @callback
+        def async_unregister():
+            """Remove the registration."""
+            if self._routes.get(relay, (None,))[0] == handler:
+                del self._routes[relay]
+
+        return async_unregister
+
+    @callback
+    def _message_received(self, msg):
+        """Dispatch a relay state to its owner."""
+        try:
+            relay = int(msg.topic[len(self._prefix):])
+        except ValueError:
+            return
+        route = self._routes.get(relay)
+        if route is None:
+            _LOGGER.debug("Relay %s has no cover", relay)
+            return
+        handler, direction = route
+        handler(direction, msg.payload == PAYLOAD_ON)
+
+    @callback
+    def async_set(self, relay, payload, published=None):
+        """Switch relay, payload is a duration in ms or PAYLOAD_OFF.
+
+        Switching a relay on is queued in the current batch, switching it
+        off is published right away and cancels its queued start.
+
+        Args:
+            published (callable): called without arguments once the start
+                is published, not if it is cancelled before
+        """
+        if payload == PAYLOAD_OFF:
+            self.async_cancel(relay)
+            self._publish(relay, payload)
+            return
+
+        self._starts.pop(relay, None)
+        self._starts[relay] = (payload, published)
+        if self._flush is None:
+            self._flush = self._hass.loop.call_soon(self._async_flush)
+
+    @callback
+    def async_cancel(self, relay):
+        """Drop the queued start of relay.
+
+        Returns:
+            True if the start was still queued, False if it was published
+        """
+        return self._starts.pop(relay, None) is not None
+
+    @callback
+    def _async_flush(self):
+        """Publish the queued starts, stagger seconds apart."""
+        self._flush = None
+        loop = self._hass.loop
+        while self._starts:
+            now = loop.time()
+            if self._last_start is not None and self.stagger:
+                wait = self._last_start + self.stagger - now
+                if wait > 0.001:
+                    self._flush = loop.call_later(wait, self._async_flush)
+                    return
+            relay, (payload, published) = self._starts.popitem(last=False)
+            self._last_start = now
+            self._publish(relay, payload)
+            if published is not None:
+                published()
+
+    def _publish(self, relay, payload):
+        """Publish a relay command."""
+        self._hass.components.mqtt.async_publish(
+            M_DUINO_RELAY_SET.format(relay), payload, qos=0, retain=False)
@@ -0,0 +1,183 @@
+"""
+Stand-in for the relays of an m-duino board.
+
+Listens to devices/m-duino/relay/+/set like the board does: a number of
+milliseconds switches the relay on for that long, "false" switches it off.
+Every relay change is published as "true"/"false" on
+devices/m-duino/relay/N. Commands and reports can be delayed by a random
+jitter, or dropped, to test the covers against a flaky board or network.
+As they share one connection, commands and reports each go through a FIFO
+and are never reordered.
+
+RelayBoard holds the simulation and can be driven in-process, see
+cover_benchmark.py; run the module to serve it on an MQTT broker:
+
+    python homegw/m_duino_simulator.py --host localhost --jitter 50 --drop 0.01
+"""
+import argparse
+import asyncio
+import logging
+import random
+from collections import deque
+
+_LOGGER = logging.getLogger(__name__)
+
+M_DUINO_RELAY = "devices/m-duino/relay/{}"
+M_DUINO_RELAY_SET = M_DUINO_RELAY + "/set"
+
+PAYLOAD_ON = "true"
+PAYLOAD_OFF = "false"
+
+
+class RelayBoard(object):
+    """Simulated relays.
+
+    Args:
+        loop: asyncio event loop timing the relays
+        publish (callable): called with (relay, payload) to report a relay
+        jitter (float): maximum random delay, in seconds, of commands and
+            reports
+        drop (float): probability of losing a command or a report
+        listener (callable): called with (relay, on, loop time) when a relay
+            actually switches, whether its report is lost or not
+    """
+
+    def __init__(self, loop, publish, jitter=0, drop=0, listener=None):
+        """Initialize the board, every relay off."""
+        self._loop = loop
+        self._publish = publish
+        self.jitter = jitter
+        self.drop = drop
+        self._listener = listener
+        self._timers = {}
+        self._command_queue = deque()
+        self._report_queue = deque()
+        self._last_command = 0
+        self._last_report = 0
+        self.commands = 0
+        self.dropped = 0
+
+    def _lost(self):
+        """Return True if a message is lost."""
+        if self.drop and random.random() < self.drop:
+            self.dropped += 1
+            return True
+        return False
+
+    def _send(self, queue, last, message):
+        """Queue message, arriving after a jitter but not before last.
+
+        The timer of a message delivers the oldest queued one, so messages
+        arriving at the same loop time can't swap.
+
+        Returns:
+            loop time of arrival
+        """
+        now = self._loop.time()
+        arrival = now + (random.uniform(0, self.jitter) if self.jitter else 0)
+        arrival = max(arrival, last)
+        queue.append(message)
+        self._loop.call_at(arrival, self._deliver, queue)
+        return arrival
+
+    @staticmethod
+    def _deliver(queue):
+        """Deliver the oldest message of queue."""
+        handler, *args = queue.popleft()
+        handler(*args)
+
+    def is_on(self, relay):
+        """Return True if relay is on."""
+        return relay in self._timers
+
+    def set(self, relay, payload):
+        """Handle a command received on the set topic of relay."""
+        self.commands += 1
+        if self._lost():
+            return
+        payload = payload.decode() if isinstance(payload, bytes) \
+            else str(payload)
+        if payload == PAYLOAD_OFF:
+            duration = None
+        else:
+            try:
+                duration = int(payload) / 1000
+            except ValueError:
+                _LOGGER.warning("Invalid command for relay %s: %s",
+                                relay, payload)
+                return
+        self._last_command = self._send(
+            self._command_queue, self._last_command,
+            (self._switch, relay, duration))
+
+    def _switch(self, relay, duration):
+        """Switch relay on for duration seconds, or off if None."""
+        timer = self._timers.pop(relay, None)
+        if timer is not None:
+            timer.cancel()
+        if duration is not None:
+            self._timers[relay] = self._loop.call_later(
+                duration, self._switch, relay, None)
+        elif timer is None:
+            return
+        self._changed(relay, duration is not None)
+
+    def _changed(self, relay, on):
+        """Report a relay change."""
+        if self._listener is not None:
+            self._listener(relay, on, self._loop.time())
+        if self._lost():
+            return
+        self._last_report = self._send(
+            self._report_queue, self._last_report,
+            (self._publish, relay, PAYLOAD_ON if on else PAYLOAD_OFF))
+
+
+def main():
+    """Serve a simulated board on an MQTT broker."""
+    import paho.mqtt.client as mqtt
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--jitter', type=int, default=0,
+                        help="maximum delay of messages, in milliseconds")
+    parser.add_argument('--drop', type=float, default=0,
+                        help="probability of losing a message")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    loop = asyncio.get_event_loop()
+    client = mqtt.Client()
+
+    def publish(relay, payload):
+        _LOGGER.info("relay %s: %s", relay, payload)
+        client.publish(M_DUINO_RELAY.format(relay), payload)
+
+    board = RelayBoard(loop, publish, args.jitter / 1000, args.drop)
+    prefix = M_DUINO_RELAY.format('')
+
+    def on_connect(client, userdata, flags, rc):
+        client.subscribe(M_DUINO_RELAY_SET.format('+'))
+
+    def on_message(client, userdata, msg):
+        try:
+            relay = int(msg.topic[len(prefix):].split('/')[0])
+        except ValueError:
+            return
+        loop.call_soon_threadsafe(board.set, relay, msg.payload)
+
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(args.host, args.port)
+    client.loop_start()
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.loop_stop()
+
+
+if __name__ == '__main__':
+    main()
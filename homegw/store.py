@@ -0,0 +1,372 @@
+"""
+Compact on-disk time-series store for homegw readings.
+
+Every entity gets one append-only file of fixed-width records per tier,
+under <config>/homegw/:
+
+- raw: (timestamp, temperature, humidity, pressure), kept RAW_RETENTION
+- 5 min and 1 h tiers: (bucket start, and count/min/max/mean of each
+  quantity), the 5 min tier kept TIER_5M_RETENTION, the 1 h tier forever
+
+Files are read through numpy memory maps, so statistics over any range only
+touch the records of that range in the finest tier that still covers it.
+The homegw.statistics service fires a homegw_statistics event with the
+min/max/mean of each quantity over a range.
+"""
+import logging
+import math
+import os
+import struct
+import threading
+import time
+from datetime import timedelta
+
+import voluptuous as vol
+
+from homeassistant.const import ATTR_ENTITY_ID, EVENT_HOMEASSISTANT_STOP
+from homeassistant.core import callback
+from homeassistant.helpers.event import async_track_time_interval
+import homeassistant.helpers.config_validation as cv
+import homeassistant.util.dt as dt_util
+
+_LOGGER = logging.getLogger(__name__)
+
+DOMAIN = 'homegw'
+DATA_HOMEGW_STORE = 'homegw_store'
+STORE_DIR = 'homegw'
+
+SERVICE_STATISTICS = 'statistics'
+EVENT_STATISTICS = 'homegw_statistics'
+
+ATTR_START = 'start'
+ATTR_END = 'end'
+
+QUANTITIES = ('temperature', 'humidity', 'pressure')
+AGGREGATES = ('count', 'min', 'max', 'mean')
+
+RAW_RECORD = struct.Struct('<d' + 'd' * len(QUANTITIES))
+TIER_RECORD = struct.Struct('<d' + 'd' * len(QUANTITIES) * len(AGGREGATES))
+
+RAW_RETENTION = 7 * 86400  # seconds
+TIER_5M_RETENTION = 180 * 86400  # seconds
+
+# (file suffix, bucket seconds, retention seconds), finest first
+TIERS = (
+    ('raw', None, RAW_RETENTION),
+    ('5m', 300, TIER_5M_RETENTION),
+    ('1h', 3600, None),
+)
+
+FLUSH_INTERVAL = timedelta(minutes=1)
+COMPACT_INTERVAL = timedelta(days=1)
+
+STATISTICS_SCHEMA = vol.Schema({
+    vol.Required(ATTR_ENTITY_ID): cv.entity_id,
+    vol.Required(ATTR_START): cv.datetime,
+    vol.Optional(ATTR_END): cv.datetime,
+})
+
+
+def _dtype(np, suffix):
+    """Return the numpy record type of a tier."""
+    if suffix == 'raw':
+        return np.dtype([('timestamp', '<f8')] +
+                        [(quantity, '<f8') for quantity in QUANTITIES])
+    return np.dtype([('timestamp', '<f8')] +
+                    [('{}_{}'.format(quantity, aggregate), '<f8')
+                     for quantity in QUANTITIES for aggregate in AGGREGATES])
+
+
+@callback
+def async_get_store(hass):
+    """Return the store, creating it and its service on first use."""
+    store = hass.data.get(DATA_HOMEGW_STORE)
+    if store is None:
+        store = hass.data[DATA_HOMEGW_STORE] = HomeGWStore(
+            hass, hass.config.path(STORE_DIR))
+    return store
+
+
+class _Bucket(object):
+    """Running aggregates of one time bucket."""
+
+    __slots__ = ('start', 'count', 'min', 'max', 'sum')
+
+    def __init__(self, start):
+        """Initialize an empty bucket."""
+        self.start = start
+        self.count = [0] * len(QUANTITIES)
+        self.min = [math.inf] * len(QUANTITIES)
+        self.max = [-math.inf] * len(QUANTITIES)
+        self.sum = [0.0] * len(QUANTITIES)
+
+    def add(self, values):
+        """Add a sample, None values are skipped."""
+        for i, value in enumerate(values):
+            if value is None:
+                continue
+            self.count[i] += 1
+            self.min[i] = min(self.min[i], value)
+            self.max[i] = max(self.max[i], value)
+            self.sum[i] += value
+
+    def record(self):
+        """Return the packed tier record of the bucket."""
+        fields = [self.start]
+        for i in range(len(QUANTITIES)):
+            if self.count[i]:
+                fields += [self.count[i], self.min[i], self.max[i],
+                           self.sum[i] / self.count[i]]
+            else:
+                fields += [0, math.nan, math.nan, math.nan]
+        return TIER_RECORD.pack(*fields)
+
+
+class Series(object):
+    """Readings of one entity."""
+
+    def __init__(self, path):
+        """Initialize the series stored under path (without suffix)."""
+        self._path = path
+        self._pending = {suffix: [] for suffix, _, _ in TIERS}
+        self._buckets = {}
+
+    def file(self, suffix):
+        """Return the file of a tier."""
+        return "{}.{}".format(self._path, suffix)
+
+    def append(self, timestamp, temperature=None, humidity=None,
+               pressure=None):
+        """Queue a reading, written on the next flush."""
+        values = (temperature, humidity, pressure)
+        self._pending['raw'].append(RAW_RECORD.pack(
+            timestamp, *[math.nan if value is None else value
+                         for value in values]))
+        for suffix, size, _ in TIERS[1:]:
+            start = timestamp - timestamp % size
+            bucket = self._buckets.get(suffix)
+            if bucket is not None and bucket.start != start:
+                self._pending[suffix].append(bucket.record())
+                bucket = None
+            if bucket is None:
+                bucket = self._buckets[suffix] = _Bucket(start)
+            bucket.add(values)
+
+    @callback
+    def async_take_pending(self, close=False):
+        """Return the queued records and start a new queue.
+
+        With close, the buckets still open are returned too, and a later
+        reading in the same bucket starts a new record with the same start.
+        """
+        pending = self._pending
+        self._pending = {suffix: [] for suffix, _, _ in TIERS}
+        if close:
+            for suffix, bucket in self._buckets.items():
+                pending[suffix].append(bucket.record())
+            self._buckets = {}
+        return pending
+
+    def write(self, pending):
+        """Append records returned by async_take_pending to the files."""
+        for suffix, records in pending.items():
+            if records:
+                size = len(records[0])
+                with open(self.file(suffix), 'ab') as fd:
+                    # a record cut short, e.g. by a crash, would shift the
+                    # records appended after it
+                    partial = fd.tell() % size
+                    if partial:
+                        fd.truncate(fd.tell() - partial)
+                    fd.write(b''.join(records))
+
+    def compact(self, now):
+        """Drop the records older than the retention of each tier."""
+        import numpy as np
+
+        for suffix, _, retention in TIERS:
+            if retention is None:
+                continue
+            data = self.load(suffix)
+            if data is None:
+                continue
+            keep = np.searchsorted(data['timestamp'], now - retention)
+            if not keep:
+                continue
+            tmp = self.file(suffix) + '.tmp'
+            data[keep:].tofile(tmp)
+            del data
+            os.replace(tmp, self.file(suffix))
+
+    def load(self, suffix):
+        """Return a read only memory map of a tier, None if empty.
+
+        A partial record at the end of the file is left out.
+        """
+        import numpy as np
+
+        dtype = _dtype(np, suffix)
+        try:
+            count = os.path.getsize(self.file(suffix)) // dtype.itemsize
+        except OSError:
+            return None
+        if not count:
+            return None
+        return np.memmap(self.file(suffix), dtype=dtype, mode='r',
+                         shape=(count,))
+
+    def statistics(self, start, end):
+        """Return count/min/max/mean of each quantity between start and end.
+
+        Uses the finest tier whose first record is not after start, or the
+        one reaching furthest back if none does. A bucket written in parts,
+        across a restart, has several records with the same start, which
+        are merged weighted by their counts.
+        """
+        import numpy as np
+
+        suffix, data = None, None
+        for tier, _, _ in TIERS:
+            tier_data = self.load(tier)
+            if tier_data is None:
+                continue
+            if data is None or tier_data['timestamp'][0] < \
+                    data['timestamp'][0]:
+                suffix, data = tier, tier_data
+            if tier_data['timestamp'][0] <= start:
+                suffix, data = tier, tier_data
+                break
+
+        result = {quantity: {'count': 0, 'min': None, 'max': None,
+                             'mean': None} for quantity in QUANTITIES}
+        if data is None:
+            return result
+
+        first, last = np.searchsorted(data['timestamp'], (start, end),
+                                      side='left')
+        data = data[first:last]
+        for quantity in QUANTITIES:
+            if suffix == 'raw':
+                values = data[quantity][~np.isnan(data[quantity])]
+                count = len(values)
+                if count:
+                    minimum, maximum = values.min(), values.max()
+                    mean = values.mean()
+            else:
+                counts = data[quantity + '_count']
+                valid = counts > 0
+                count = int(counts.sum())
+                if count:
+                    minimum = data[quantity + '_min'][valid].min()
+                    maximum = data[quantity + '_max'][valid].max()
+                    mean = (data[quantity + '_mean'][valid] *
+                            counts[valid]).sum() / count
+            if count:
+                result[quantity] = {'count': int(count),
+                                    'min': float(minimum),
+                                    'max': float(maximum),
+                                    'mean': float(mean)}
+        return result
+
+
+class HomeGWStore(object):
+    """Series of every homegw entity."""
+
+    def __init__(self, hass, path):
+        """Initialize the store and register its service."""
+        self._hass = hass
+        self._path = path
+        self._series = {}
+        self._lock = threading.Lock()
+
+        async_track_time_interval(hass, self._async_flush, FLUSH_INTERVAL)
+        async_track_time_interval(hass, self._async_compact,
+                                  COMPACT_INTERVAL)
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP,
+                                   self._async_stop)
+        hass.services.async_register(
+            DOMAIN, SERVICE_STATISTICS, self._async_statistics,
+            schema=STATISTICS_SCHEMA)
+
+    @callback
+    def series(self, entity_id):
+        """Return the series of entity_id."""
+        if entity_id not in self._series:
+            self._series[entity_id] = Series(
+                os.path.join(self._path, entity_id))
+        return self._series[entity_id]
+
+    def _write(self, pending):
+        """Write the queued records of every series."""
+        with self._lock:
+            try:
+                os.makedirs(self._path, exist_ok=True)
+                for series, records in pending:
+                    series.write(records)
+            except OSError as err:
+                _LOGGER.error("Can't write homegw history: %s", err)
+
+    def _compact(self, series):
+        """Apply the retention of every series."""
+        now = time.time()
+        with self._lock:
+            for entry in series:
+                try:
+                    entry.compact(now)
+                except (OSError, ValueError) as err:
+                    _LOGGER.error("Can't compact homegw history: %s", err)
+
+    def _statistics(self, series, start, end):
+        """Return the statistics of series, consistent with the writes.
+
+        Returns:
+            None if the history can't be read
+        """
+        with self._lock:
+            try:
+                return series.statistics(start, end)
+            except (OSError, ValueError) as err:
+                _LOGGER.error("Can't read homegw history: %s", err)
+                return None
+
+    async def _async_flush(self, now=None, close=False):
+        """Write the queued records in the executor.
+
+        With close, the open buckets are written too.
+        """
+        pending = [(series, series.async_take_pending(close))
+                   for series in self._series.values()]
+        await self._hass.async_add_executor_job(self._write, pending)
+
+    async def _async_stop(self, event):
+        """Write everything, open buckets included, before stopping."""
+        await self._async_flush(close=True)
+
+    async def _async_compact(self, now=None):
+        """Apply the retention in the executor."""
+        await self._async_flush()
+        await self._hass.async_add_executor_job(
+            self._compact, list(self._series.values()))
+
+    async def _async_statistics(self, call):
+        """Handle the statistics service."""
+        entity_id = call.data[ATTR_ENTITY_ID]
+        start = call.data[ATTR_START]
+        end = call.data.get(ATTR_END, dt_util.utcnow())
+        if entity_id not in self._series:
+            _LOGGER.error("No homegw history for %s", entity_id)
+            return
+
+        await self._async_flush()
+        result = await self._hass.async_add_executor_job(
+            self._statistics, self._series[entity_id],
+            dt_util.as_utc(start).timestamp(), dt_util.as_utc(end).timestamp())
+        if result is None:
+            return
+
+        result.update({
+            ATTR_ENTITY_ID: entity_id,
+            ATTR_START: start.isoformat(),
+            ATTR_END: end.isoformat(),
+        })
+        self._hass.bus.async_fire(EVENT_STATISTICS, result)
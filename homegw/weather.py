@@ -5,75 +5,108 @@ https://github.com/dgomes/homeGW
 """
 import asyncio
 import logging
-import json
+import time
+from datetime import timedelta
 import voluptuous as vol
 
 from homeassistant.components.weather import (
-    WeatherEntity)
+    WeatherEntity, ATTR_FORECAST_CONDITION, ATTR_FORECAST_TEMP,
+    ATTR_FORECAST_TIME)
 from homeassistant.const import (
-    TEMP_CELSIUS, CONF_NAME, STATE_UNKNOWN, STATE_UNAVAILABLE)
+    TEMP_CELSIUS, CONF_NAME, STATE_UNKNOWN)
 from homeassistant.core import callback
 from homeassistant.components.weather import (
     PLATFORM_SCHEMA)
 import homeassistant.helpers.config_validation as cv
-from homeassistant.helpers.event import async_track_state_change
 from homeassistant.helpers.restore_state import RestoreEntity 
-from homeassistant.helpers.sun import is_up
+import homeassistant.util.dt as dt_util
 
 import os
 import sys
 sys.path.append(os.sep.join(os.path.abspath(__file__).split(os.sep)[:-2]))
-from filter_helper import Filter, FILTER_OUTLIER
+from filter_helper import Filter, new_sample, forget, filter_stats, FILTER_OUTLIER
+
+from .forecast import (
+    PressureTrend, SunSchedule, ZAMBRETTI_CONDITIONS, ZAMBRETTI_FORECASTS,
+    sea_level_pressure, zambretti)
+from .hub import async_get_hub, DEFAULT_DEDUP_WINDOW
+from .store import async_get_store
 
 
 _LOGGER = logging.getLogger(__name__)
 
 CONF_SERIAL_ENTITY = "serial_sensor"
+CONF_MQTT_TOPIC = "mqtt_topic"
+CONF_DEDUP_WINDOW = "dedup_window"
+CONF_HISTORY = "history"
 DEFAULT_NAME = "HomeGW Weather Station"
 
-ATTR_HOMEGW_DEV = 'dev'
 ATTR_HOMEGW_TEMPERATURE = 'temp'
 ATTR_HOMEGW_HUMIDITY = 'hum'
 ATTR_HOMEGW_PRESSURE = 'pressure'
 ATTR_HOMEGW_ID = 'id'
 ATTR_HOMEGW_CHANNEL = 'ch'
 ATTR_HOMEGW_BATTERY = 'batt'
+ATTR_OUTLIERS = '{}_outliers'
+ATTR_PRESSURE_TREND_3H = 'pressure_trend_3h'
+ATTR_PRESSURE_TREND_12H = 'pressure_trend_12h'
+ATTR_ZAMBRETTI = 'zambretti'
+
+FORECAST_HORIZON = timedelta(hours=12)
 
 VALUE_HOMEGW_DEV_WEATHER = 'weather'
 
-PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
-    vol.Required(CONF_SERIAL_ENTITY): cv.entity_id,
+PLATFORM_SCHEMA = vol.All(PLATFORM_SCHEMA.extend({
+    vol.Exclusive(CONF_SERIAL_ENTITY, 'source'): cv.entity_id,
+    vol.Exclusive(CONF_MQTT_TOPIC, 'source'): cv.string,
+    vol.Optional(CONF_DEDUP_WINDOW, default=DEFAULT_DEDUP_WINDOW):
+        cv.positive_int,
+    vol.Optional(CONF_HISTORY, default=True): cv.boolean,
     vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
-})
+}), cv.has_at_least_one_key(CONF_SERIAL_ENTITY, CONF_MQTT_TOPIC))
 
 
 async def async_setup_platform(hass, config, async_add_devices, discovery_info=None):
     """Set up the homeGW weather."""
     name = config.get(CONF_NAME, DEFAULT_NAME)
-    serial_sensor = config.get(CONF_SERIAL_ENTITY)
+    hub = await async_get_hub(hass, config.get(CONF_SERIAL_ENTITY),
+                              config.get(CONF_MQTT_TOPIC),
+                              config[CONF_DEDUP_WINDOW])
+    store = async_get_store(hass) if config[CONF_HISTORY] else None
 
     async_add_devices([
-        HomeGWWeather(hass, name, serial_sensor)
+        HomeGWWeather(hass, name, hub, store)
     ])
 
 
 class HomeGWWeather(WeatherEntity, RestoreEntity):
     """Representation of a weather condition."""
 
-    def __init__(self, hass, name, serial_sensor):
-        """Initialize the HomeGW weather."""
+    def __init__(self, hass, name, hub, store):
+        """Initialize the HomeGW weather, recording readings in store."""
         self._name = name
         self._hass = hass
+        self._hub = hub
+        self._store = store
+        self._series = None
+        self._unregister = None
         self._temperature = None
         self._humidity = None
         self._pressure = None
         self._channel = self._id = self._battery = None
-
-        async_track_state_change(hass, serial_sensor, self._sensor_changed)
+        self._trend_3h = PressureTrend(3 * 3600)
+        self._trend_12h = PressureTrend(12 * 3600)
+        self._zambretti = None
+        self._forecast = None
+        self._sun = SunSchedule(hass)
 
     async def async_added_to_hass(self):
         """Run when entity about to be added."""
         await super().async_added_to_hass()
+        if self._store is not None:
+            self._series = self._store.series(self.entity_id)
+        self._unregister = self._hub.async_register(
+            self._sensor_changed, VALUE_HOMEGW_DEV_WEATHER)
         old_state = await self.async_get_last_state()
         if old_state is not None:
             if old_state.attributes.get(ATTR_HOMEGW_TEMPERATURE):
@@ -86,33 +119,61 @@ class HomeGWWeather(WeatherEntity, RestoreEntity):
                 self._pressure = int(
                     old_state.attributes[ATTR_HOMEGW_PRESSURE])
 
-    @callback
-    def _sensor_changed(self, entity_id, old_state, new_state):
-        """Handle sensor state changes."""
-        if new_state is None:
-            return
-        elif new_state.state in [STATE_UNKNOWN, STATE_UNAVAILABLE]:
-            return
+    async def async_will_remove_from_hass(self):
+        """Stop receiving packets and drop the filter state."""
+        await super().async_will_remove_from_hass()
+        if self._unregister is not None:
+            self._unregister()
+            self._unregister = None
+        forget(self)
 
-        try:
-            payload = json.loads(new_state.state)
-        except Exception:
-            _LOGGER.warning("Could not process: %s", new_state.state)
-            return
+    @callback
+    def _sensor_changed(self, reading):
+        """Handle a packet of the weather station."""
+        self._temperature = reading.temperature
+        self._humidity = reading.humidity
+        self._id = reading.id
+        self._channel = reading.channel
+        self._battery = reading.battery
+        new_sample(self)
+        temperature = self.temperature
+        humidity = self.humidity
+
+        now = time.time()
+        if reading.pressure is not None:
+            self._pressure = reading.pressure
+            self._trend_3h.append(now, reading.pressure)
+            self._trend_12h.append(now, reading.pressure)
+            self._update_forecast()
+
+        if self._series is not None:
+            self._series.append(now, temperature, humidity,
+                                reading.pressure)
 
-        if payload[ATTR_HOMEGW_DEV] != VALUE_HOMEGW_DEV_WEATHER:
-            return
+        self.schedule_update_ha_state()
 
-        self._temperature = float(payload[ATTR_HOMEGW_TEMPERATURE])
-        self._humidity = int(payload[ATTR_HOMEGW_HUMIDITY])
-        self._id = int(payload[ATTR_HOMEGW_ID])
-        self._channel = int(payload[ATTR_HOMEGW_CHANNEL])
-        self._battery = bool(payload[ATTR_HOMEGW_BATTERY])
+    def _update_forecast(self):
+        """Update the Zambretti forecast from the pressure trend.
 
-        if payload.get(ATTR_HOMEGW_PRESSURE) is not None:
-            self._pressure = int(payload[ATTR_HOMEGW_PRESSURE])/100 #unit hPa
+        Zambretti doesn't forecast temperatures, the forecast carries the
+        current one, which the weather entity requires.
+        """
+        slope = self._trend_3h.slope
+        if slope is None:
+            return
 
-        self.schedule_update_ha_state()
+        temperature = self.temperature
+        pressure = sea_level_pressure(
+            self._pressure, self._hass.config.elevation,
+            15 if temperature is None else temperature)
+        now = dt_util.now()
+        self._zambretti = zambretti(pressure, slope * 3, now.month,
+                                    self._hass.config.latitude >= 0)
+        self._forecast = [{
+            ATTR_FORECAST_TIME: (now + FORECAST_HORIZON).isoformat(),
+            ATTR_FORECAST_CONDITION: ZAMBRETTI_CONDITIONS[self._zambretti],
+            ATTR_FORECAST_TEMP: temperature,
+        }]
 
     @property
     def name(self):
@@ -125,7 +186,7 @@ class HomeGWWeather(WeatherEntity, RestoreEntity):
         return False
 
     @property
-    @Filter(FILTER_OUTLIER,
+    @Filter(FILTER_OUTLIER, on_sample=True,
             window_size=3, precision=2, entity="unnamed", radius=2.0)
     def temperature(self):
         """Return the temperature."""
@@ -137,7 +198,7 @@ class HomeGWWeather(WeatherEntity, RestoreEntity):
         return TEMP_CELSIUS
 
     @property
-    @Filter(FILTER_OUTLIER,
+    @Filter(FILTER_OUTLIER, on_sample=True,
             window_size=3, precision=2, entity="unnamed", radius=5.0)
     def humidity(self):
         """Return the humidity."""
@@ -148,6 +209,11 @@ class HomeGWWeather(WeatherEntity, RestoreEntity):
         """Return the pressure."""
         return self._pressure
 
+    @property
+    def forecast(self):
+        """Return the local forecast, once 1 hour of pressure is known."""
+        return self._forecast
+
     @property
     def attribution(self):
         """Return the attribution."""
@@ -164,6 +230,16 @@ class HomeGWWeather(WeatherEntity, RestoreEntity):
             attrs[ATTR_HOMEGW_ID] = self._id
         if self._battery is not None:
             attrs[ATTR_HOMEGW_BATTERY] = self._battery
+        for quantity in ('temperature', 'humidity'):
+            stats = filter_stats(self, quantity)
+            if stats is not None:
+                attrs[ATTR_OUTLIERS.format(quantity)] = stats['outliers']
+        for attr, trend in ((ATTR_PRESSURE_TREND_3H, self._trend_3h),
+                            (ATTR_PRESSURE_TREND_12H, self._trend_12h)):
+            if trend.slope is not None:
+                attrs[attr] = round(trend.slope, 2)
+        if self._zambretti is not None:
+            attrs[ATTR_ZAMBRETTI] = ZAMBRETTI_FORECASTS[self._zambretti]
         return attrs
 
     @property
@@ -174,6 +250,6 @@ class HomeGWWeather(WeatherEntity, RestoreEntity):
 
         if self._humidity > 80:
             return 'rainy'
-        if is_up(self._hass):
+        if self._sun.is_up():
             return 'sunny'
         return 'clear-night' 
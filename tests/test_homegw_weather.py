@@ -0,0 +1,49 @@
+"""Tests of the homegw weather platform."""
+import os
+import sys
+import types
+
+import pytest
+
+pytest.importorskip('homeassistant.components.weather')
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from homeassistant.components.weather import (  # noqa: E402
+    ATTR_FORECAST, ATTR_FORECAST_CONDITION, ATTR_FORECAST_TEMP)
+from homeassistant.util.unit_system import METRIC_SYSTEM  # noqa: E402
+from homegw.weather import HomeGWWeather, ATTR_ZAMBRETTI  # noqa: E402
+
+
+@pytest.fixture
+def hass():
+    """Return the parts of hass the weather entity reads."""
+    return types.SimpleNamespace(
+        data={},
+        config=types.SimpleNamespace(units=METRIC_SYSTEM, elevation=100,
+                                     latitude=40.0))
+
+
+def test_state_attributes_with_forecast(hass):
+    """The attributes include the forecast once the trend is known."""
+    weather = HomeGWWeather(hass, "weather", None, None)
+    weather.hass = hass
+    weather._temperature = 18.5
+    weather._humidity = 60
+    weather._pressure = 1005
+
+    start = 1600000000
+    for minute in range(0, 181, 10):
+        # falling 1 hPa per hour
+        pressure = 1008 - minute / 60
+        weather._trend_3h.append(start + minute * 60, pressure)
+        weather._trend_12h.append(start + minute * 60, pressure)
+    weather._update_forecast()
+
+    attrs = weather.state_attributes
+    forecast, = attrs[ATTR_FORECAST]
+    assert forecast[ATTR_FORECAST_TEMP] == 18.5
+    assert forecast[ATTR_FORECAST_CONDITION]
+
+    attrs = weather.device_state_attributes
+    assert attrs[ATTR_ZAMBRETTI]
+    assert attrs['pressure_trend_3h'] == pytest.approx(-1)